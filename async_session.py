@@ -0,0 +1,142 @@
+#!/usr/bin/python
+'''
+Publicity filtering for asyncio sessions.
+
+AsyncSession doesn't use Query class, but it proxies everything to
+synchronous Session it wraps, and loader_criteria filters statements in
+do_orm_execute event of Session. So AsyncPublicSession just wraps
+PublicSession: execute(), scalars(), get() and stream() of it return public
+objects only. Requires SQLAlchemy 1.4 or later with asyncio extension and
+async driver (tests use aiosqlite).
+
+Lazy loading doesn't work with asyncio, use selectinload() option or
+run_sync() for code touching relationships.
+'''
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from loader_criteria import PublicSession
+
+
+class AsyncPublicSession(AsyncSession):
+
+    sync_session_class = PublicSession
+
+
+if __name__=='__main__':
+    import asyncio
+    import os
+    import tempfile
+    import unittest
+    from sqlalchemy import create_engine, select, func
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.orm import selectinload
+    import base
+    from base import User, Address
+
+    class AsyncDataTestCase(base.DataTestCase):
+
+        # Both synchronous fixture session and async one use the same file
+        # database.
+
+        def create_engine(self):
+            fd, self.db_path = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            return create_engine('sqlite:///' + self.db_path)
+
+        def create_public_session(self, engine):
+            self.loop = asyncio.new_event_loop()
+            self.async_engine = create_async_engine(
+                                    'sqlite+aiosqlite:///' + self.db_path)
+            self.adbp = AsyncPublicSession(bind=self.async_engine)
+            return self.adbp.sync_session
+
+        def run_async(self, coroutine):
+            return self.loop.run_until_complete(coroutine)
+
+        def tearDown(self):
+            self.dba.close()
+            self.run_async(self.adbp.close())
+            self.run_async(self.async_engine.dispose())
+            self.loop.close()
+            self.engine.dispose()
+            os.remove(self.db_path)
+
+    # Imported test cases would be run by unittest.main() too
+
+    class AsyncUserAddressesTest(AsyncDataTestCase):
+        '''
+        UserAddressesTest run through AsyncPublicSession: each test is
+        called with run_sync(), so that lazy loads work.
+        '''
+
+    # AsyncSession wraps Session in 2.0 mode
+    UNSUPPORTED = {
+        'test_slice': 'negative indexes are not supported in 2.0 mode',
+    }
+
+    def _async_test(name):
+        test = getattr(base.UserAddressesTest, name)
+        def method(self):
+            self.run_async(self.adbp.run_sync(lambda session: test(self)))
+        method.__name__ = name
+        if name in UNSUPPORTED:
+            method = unittest.skip(UNSUPPORTED[name])(method)
+        return method
+
+    for name in unittest.TestLoader().getTestCaseNames(base.UserAddressesTest):
+        setattr(AsyncUserAddressesTest, name, _async_test(name))
+
+    class AsyncSessionTest(AsyncDataTestCase):
+
+        def test_execute(self):
+            async def names():
+                result = await self.adbp.execute(
+                                    select(User.name).order_by(User.id))
+                return result.scalars().all()
+            self.assertEqual(self.run_async(names()),
+                             ['u1', 'u2', 'u5', 'u6'])
+
+        def test_count(self):
+            async def count():
+                return await self.adbp.scalar(
+                            select(func.count()).select_from(Address))
+            self.assertEqual(self.run_async(count()), 5)
+
+        def test_get(self):
+            ids = dict(self.dba.query(User.name, User.id))
+            async def get(name):
+                user = await self.adbp.get(User, ids[name])
+                return user and user.name
+            self.assertEqual(self.run_async(get('u1')), 'u1')
+            self.assertIsNone(self.run_async(get('u3')))
+
+        def test_get_after_change(self):
+            ids = dict(self.dba.query(User.name, User.id))
+            async def change():
+                user = await self.adbp.get(User, ids['u1'])
+                user.public = False
+                await self.adbp.commit()
+                return await self.adbp.get(User, ids['u1'])
+            self.assertIsNone(self.run_async(change()))
+
+        def test_stream(self):
+            async def emails():
+                result = await self.adbp.stream_scalars(
+                                    select(Address).order_by(Address.id))
+                return [addr.email async for addr in result]
+            self.assertEqual(self.run_async(emails()),
+                             ['u1a1', 'u1a2', 'u2a2', 'u4a2', 'u5a1'])
+
+        def test_selectinload(self):
+            async def emails():
+                result = await self.adbp.execute(
+                            select(User).options(selectinload(User.addresses))
+                                        .order_by(User.id))
+                return dict((user.name,
+                             sorted(addr.email for addr in user.addresses))
+                            for user in result.scalars())
+            self.assertEqual(self.run_async(emails()),
+                             {'u1': ['u1a1', 'u1a2'], 'u2': ['u2a2'],
+                              'u5': ['u5a1'], 'u6': []})
+
+    unittest.main()
@@ -1,8 +1,11 @@
 import unittest
 from sqlalchemy import *
+from sqlalchemy import event, exc as sa_exc
 from sqlalchemy.orm import *
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
+import publicity
+import effective
 
 
 Base = declarative_base()
@@ -26,6 +29,10 @@ class Address(Base):
     user_id = Column(Integer, ForeignKey('user.id'))
     public = Column(Boolean, nullable=False)
 
+    @hybrid_property
+    def member_visible(self):
+        return self.email!=None
+
 
 class User_Photo(Base):
     __tablename__ = 'user_photo'
@@ -56,6 +63,7 @@ class Doc(Base):
 
     NEWS = 1
     ANNOUNCE = 2
+    EVENT = 3
 
     id = Column(Integer, primary_key=True)
     type = Column(Integer)
@@ -67,7 +75,8 @@ class Doc(Base):
     def __new__(cls, **initial):
         if 'type' in initial:
             cls = {Doc.NEWS: News,
-                   Doc.ANNOUNCE: Announce}[initial['type']]
+                   Doc.ANNOUNCE: Announce,
+                   Doc.EVENT: Event}[initial['type']]
         return Base.__new__(cls)
 
 
@@ -85,22 +94,112 @@ class Announce(Doc):
     __mapper_args__ = {'polymorphic_identity': Doc.ANNOUNCE}
 
 
+class Event(Doc):
+    '''Subclass with its own publicity criterion'''
+    __tablename__ = 'event'
+
+    id = Column(Integer, ForeignKey(Doc.id), nullable=False, primary_key=True)
+    approved = Column(Boolean, nullable=False)
+
+    # Inherited column property would replace the hybrid
+    __mapper_args__ = {'polymorphic_identity': Doc.EVENT,
+                       'exclude_properties': ['public']}
+
+    @hybrid_property
+    def public(self):
+        return self.approved
+
+
 class NotFiltered(Base):
     __tablename__ = 'not_filtered'
 
     id = Column(Integer, nullable=False, primary_key=True)
 
 
-class UserAddressesTest(unittest.TestCase):
+# Models of EffectivePublicityTest, which has its own schema and fixture
+EffectiveBase = declarative_base()
+
+
+class Board(EffectiveBase):
+    __tablename__ = 'board'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    public = Column(Boolean, nullable=False)
+    topics = relation("Topic", backref="board")
+
+
+class Topic(EffectiveBase):
+    '''Public when its own flag is set and its board is public, stored in
+    effective_public column'''
+    __tablename__ = 'topic'
+
+    id = Column(Integer, primary_key=True)
+    title = Column(String)
+    board_id = Column(Integer, ForeignKey('board.id'))
+    own_public = Column(Boolean, nullable=False)
+    effective_public = Column(Boolean, nullable=False, default=False)
+    posts = relation("Post", backref="topic")
+
+    @hybrid_property
+    def public(self):
+        return self.effective_public
+
+
+class Post(EffectiveBase):
+    __tablename__ = 'post'
+
+    id = Column(Integer, primary_key=True)
+    text = Column(String)
+    topic_id = Column(Integer, ForeignKey('topic.id'))
+    own_public = Column(Boolean, nullable=False)
+    effective_public = Column(Boolean, nullable=False, default=False)
+
+    @hybrid_property
+    def public(self):
+        return self.effective_public
+
+
+effective.depends(Topic, 'own_public', ['board'])
+effective.depends(Post, 'own_public', ['topic'])
+
+
+# Members see all addresses, but only public users and photos. Staff see
+# everything.
+publicity.register_audience('members', 'member_visible')
+publicity.register_audience('staff', None)
+
+
+class DataTestCase(unittest.TestCase):
     '''
-    Simple set of tests with the same set of initial objects from original
-    recipe at http://www.sqlalchemy.org/trac/wiki/UsageRecipes/PreFilteredQuery
+    Tests with the same set of initial objects from original recipe at
+    http://www.sqlalchemy.org/trac/wiki/UsageRecipes/PreFilteredQuery
     '''
 
     QUERY_CLS = None  # Must be set before running tests
+    # Called with engine and test id after fixture is created to watch
+    # statements emitted by the test (see query_shapes.py)
+    STATEMENT_RECORDER = None
+
+    def create_engine(self):
+        return create_engine('sqlite://')#, echo=True)
+
+    def create_public_session(self, engine):
+        return sessionmaker(bind=engine, query_cls=self.QUERY_CLS)()
+
+    def make_query_cls(self, **attrs):
+        '''Returns subclass of tested query class with attributes (e.g. cache
+        used by optional feature) set.'''
+        return type(self.QUERY_CLS.__name__, (self.QUERY_CLS,), attrs)
+
+    def make_sessionmaker(self, **attrs):
+        '''Returns sessionmaker of public sessions using query class made by
+        make_query_cls().'''
+        return sessionmaker(bind=self.engine,
+                            query_cls=self.make_query_cls(**attrs))
 
     def setUp(self):
-        engine = create_engine('sqlite://')#, echo=True)
+        self.engine = engine = self.create_engine()
         Base.metadata.create_all(engine)
         # Some solutions doen't allow creating objects with PublicQuery, so we
         # setup separate session for it.
@@ -141,18 +240,29 @@ class UserAddressesTest(unittest.TestCase):
             WithAttributeError(),
             News(title='n1', public=True),
             Announce(title='a1', public=True, date_start='tomorrow'),
+            Announce(title='a2', public=False, date_start='today'),
+            Event(title='e1', approved=True),
+            Event(title='e2', approved=False),
             NotFiltered(id=1),
             NotFiltered(id=2),
             NotFiltered(id=3),
             NotFiltered(id=4),
         ])
         self.dba.commit()
-        self.dbp = sessionmaker(bind=engine, query_cls=self.QUERY_CLS)()
+        if self.STATEMENT_RECORDER is not None:
+            self.STATEMENT_RECORDER(engine, self.id())
+        self.dbp = self.create_public_session(engine)
 
     def tearDown(self):
         self.dba.close()
         self.dbp.close()
 
+
+class UserAddressesTest(DataTestCase):
+    '''
+    Simple set of tests every solution should pass.
+    '''
+
     def test_public(self):
         # This test doesn't depend on initial state of DB
         for user in self.dbp.query(User):
@@ -204,6 +314,37 @@ class UserAddressesTest(unittest.TestCase):
         self.assertEqual(self.dbp.query(User).count(), 4)
         self.assertEqual(self.dbp.query(Address).count(), 5)
 
+    def test_join_count(self):
+        query = self.dbp.query(User).join(User.addresses)
+        self.assertEqual(query.count(), 4)
+
+    def test_distinct_count(self):
+        query = self.dbp.query(User.name).join(User.addresses).distinct()
+        self.assertEqual(query.count(), 3)
+
+    def test_group_by_count(self):
+        query = self.dbp.query(User.name).join(User.addresses)\
+                        .group_by(User.id)
+        self.assertEqual(query.count(), 3)
+
+    def test_limit_count(self):
+        query = self.dbp.query(User).join(User.addresses).limit(2)
+        self.assertEqual(query.count(), 2)
+
+    def test_from_self_join(self):
+        query = self.dbp.query(User).from_self().join(User.addresses)\
+                        .filter(Address.email=='u2a1')
+        self.assertEqual(query.all(), [])
+        query = self.dbp.query(User).limit(3).from_self()\
+                        .join(User.addresses).filter(Address.email=='u2a1')
+        self.assertEqual(query.all(), [])
+
+    def test_from_self_column(self):
+        query = self.dbp.query(User).from_self(Address.email)\
+                        .join(User.addresses)\
+                        .filter(Address.email.like('u2%'))
+        self.assertEqual([email for (email,) in query], ['u2a2'])
+
     def test_func_count(self):
         self.assertEqual(self.dbp.query(func.count(User.id)).scalar(), 4)
         self.assertEqual(self.dbp.query(func.count(Address.id)).scalar(), 5)
@@ -218,6 +359,15 @@ class UserAddressesTest(unittest.TestCase):
             user = self.dbp.query(User).get(user_id)
             self.assertIsNone(user)
 
+    def test_get_after_change(self):
+        user = self.dbp.query(User).filter_by(name='u1').scalar()
+        user_id = user.id
+        self.assertIs(self.dbp.query(User).get(user_id), user)
+        user.public = False
+        self.assertIsNone(self.dbp.query(User).get(user_id))
+        self.dbp.commit()
+        self.assertIsNone(self.dbp.query(User).get(user_id))
+
     def test_relation_after_change(self):
         user = self.dbp.query(User).filter_by(name='u1').scalar()
         self.assertEqual(len(user.addresses), 2)
@@ -260,6 +410,23 @@ class UserAddressesTest(unittest.TestCase):
         self.assertEqual(query.count(), 0)
         self.assertEqual(query.all(), [])
 
+    def test_mtm_public_by_private_exists(self):
+        query = self.dbp.query(User).filter(User.photos.any(photo='u2p1'))
+        self.assertEqual(query.count(), 0)
+        self.assertEqual(query.all(), [])
+
+    def test_aliased_any(self):
+        addresses = aliased(Address)
+        query = self.dbp.query(User).filter(
+                    User.addresses.of_type(addresses)
+                                  .any(addresses.email=='u2a1'))
+        self.assertEqual(query.all(), [])
+
+    def test_public_by_private_has(self):
+        query = self.dbp.query(Address).filter(Address.user.has(name='u4'))
+        self.assertEqual(query.count(), 0)
+        self.assertEqual(query.all(), [])
+
     def test_join_pairs(self):
         query = self.dbp.query(User.name, Address.email).join(Address.user)
         self.assertEqual(set(query.all()),
@@ -340,7 +507,638 @@ class UserAddressesTest(unittest.TestCase):
         self.assertEqual(doc.date_start, 'tomorrow')
 
 
+class EffectivePublicityTest(DataTestCase):
+    '''
+    Publicity stored in effective_public columns (see effective.py): board
+    b1 is public with topics t1 (posts p1, p2) and t2 (p3), b2 is private
+    with t3 (p4), t4 (p5) has no board. Topic t2 and post p2 are private
+    by their own flag.
+    '''
+
+    def setUp(self):
+        self.engine = engine = self.create_engine()
+        EffectiveBase.metadata.create_all(engine)
+        self.dba = sessionmaker(bind=engine)()
+        effective.install(self.dba)
+        self.dba.add_all([
+            Board(name='b1', public=True,
+                  topics=[Topic(title='t1', own_public=True,
+                                posts=[Post(text='p1', own_public=True),
+                                       Post(text='p2', own_public=False)]),
+                          Topic(title='t2', own_public=False,
+                                posts=[Post(text='p3', own_public=True)])]),
+            Board(name='b2', public=False,
+                  topics=[Topic(title='t3', own_public=True,
+                                posts=[Post(text='p4', own_public=True)])]),
+            Topic(title='t4', own_public=True,
+                  posts=[Post(text='p5', own_public=True)]),
+        ])
+        self.dba.commit()
+        self.dbp = self.create_public_session(engine)
+
+    def test_public(self):
+        titles = sorted(t.title for t in self.dbp.query(Topic))
+        self.assertEqual(titles, ['t1', 't4'])
+        self.assertEqual(sorted(p.text for p in self.dbp.query(Post)),
+                         ['p1', 'p5'])
+        self.assertEqual(self.dbp.query(Post).filter(Post.topic.has())
+                                 .count(), 2)
+
+    def test_flush(self):
+        board = self.dba.query(Board).filter_by(name='b2').one()
+        topic = self.dba.query(Topic).filter_by(title='t3').one()
+        self.assertFalse(topic.effective_public)
+        board.public = True
+        self.dba.flush()
+        self.assertTrue(topic.effective_public)
+        self.dba.commit()
+        self.assertEqual(sorted(p.text for p in self.dbp.query(Post)),
+                         ['p1', 'p4', 'p5'])
+        self.dbp.expire_all()
+        post = self.dba.query(Post).filter_by(text='p3').one()
+        post.topic = topic
+        self.dba.query(Topic).filter_by(title='t1').one().own_public = False
+        self.dba.commit()
+        self.assertEqual(sorted(p.text for p in self.dbp.query(Post)),
+                         ['p3', 'p4', 'p5'])
+
+    def test_rebuild(self):
+        self.dba.query(Board).update({'public': True},
+                                     synchronize_session=False)
+        self.dba.commit()
+        self.assertEqual(sorted(p.text for p in self.dbp.query(Post)),
+                         ['p1', 'p5'])
+        effective.rebuild(self.dba.connection())
+        self.dba.commit()
+        self.assertEqual(sorted(p.text for p in self.dbp.query(Post)),
+                         ['p1', 'p4', 'p5'])
+
+    def test_triggers(self):
+        for ddl in effective.trigger_ddl(self.engine.dialect):
+            self.dba.execute(text(ddl))
+        self.dba.execute(text("UPDATE board SET public=1 WHERE name='b2'"))
+        self.dba.execute(text("INSERT INTO post (text, topic_id, own_public, "
+                              "effective_public) SELECT 'p6', id, 1, 0 "
+                              "FROM topic WHERE title='t3'"))
+        self.dba.commit()
+        self.assertEqual(sorted(p.text for p in self.dbp.query(Post)),
+                         ['p1', 'p4', 'p5', 'p6'])
+
+
+class RegistryTest(unittest.TestCase):
+    '''
+    Publicity registry, the same for all solutions.
+    '''
+
+    @unittest.skipUnless(hasattr(Base, 'registry'),
+                         'disposing mappers of single declarative base '
+                         'requires SQLAlchemy 1.4')
+    def test_disposed_mapper_pruned(self):
+        def make_class(name):
+            class_ = type(name, (declarative_base(),), {
+                            '__tablename__': name.lower(),
+                            'id': Column(Integer, primary_key=True),
+                            'public': Column(Boolean)})
+            configure_mappers()
+            return class_
+        Temp = make_class('Temp')
+        mapper = class_mapper(Temp)
+        publicity.entity_criterion(Temp)
+        self.assertIn(mapper, publicity._registry)
+        Temp.registry.dispose()
+        # Pruned on next configuration
+        make_class('Other')
+        self.assertNotIn(mapper, publicity._registry)
+
+
+class GetManyTest(DataTestCase):
+
+    FEATURE = 'get_many'
+
+    def test_get_many(self):
+        ids = dict(self.dba.query(User.name, User.id))
+        names = ['u3', 'u1', 'u4', 'u6', 'u1']
+        users = self.dbp.query(User).get_many([ids[n] for n in names] + [0])
+        self.assertEqual([u and u.name for u in users],
+                         [None, 'u1', None, 'u6', 'u1', None])
+
+    def test_get_many_identity_map(self):
+        user = self.dbp.query(User).filter_by(name='u1').scalar()
+        addr = self.dbp.query(Address).filter_by(email='u1a1').scalar()
+        addr.public = False
+        self.dbp.flush()
+        self.assertEqual(self.dbp.query(User).get_many([user.id]), [user])
+        self.assertEqual(self.dbp.query(Address).get_many([addr.id]), [None])
+
+    def test_get_identity_map(self):
+        statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        user = self.dbp.query(User).filter_by(name='u1').scalar()
+        self.assertIs(self.dbp.query(User).get(user.id), user)
+        self.assertEqual(len(statements), 1)
+        self.dbp.expire(user)
+        self.assertIs(self.dbp.query(User).get(user.id), user)
+        self.assertEqual(len(statements), 2)
+        self.dbp.expire(user, ['public'])
+        self.assertIs(self.dbp.query(User).get(user.id), user)
+        self.assertEqual(len(statements), 3)
+
+    def test_get_many_composite(self):
+        keys = self.dba.query(User_Photo.user_id, User_Photo.photo_id).all()
+        links = self.dbp.query(User_Photo).get_many(keys + [(0, 0)])
+        self.assertEqual([(l.user_id, l.photo_id) for l in links[:-1]], keys)
+        self.assertIsNone(links[-1])
+
+    def test_get_many_coerced(self):
+        ids = dict(self.dba.query(User.name, User.id))
+        idents = [str(ids['u1']), (ids['u2'],), [str(ids['u3'])],
+                  (ids['u1'],)]
+        users = self.dbp.query(User).get_many(idents)
+        self.assertEqual([u and u.name for u in users],
+                         ['u1', 'u2', None, 'u1'])
+        self.assertIs(self.dbp.query(User).get(str(ids['u1'])), users[0])
+        key = self.dba.query(User_Photo.user_id, User_Photo.photo_id).first()
+        link, = self.dbp.query(User_Photo).get_many([tuple(map(str, key))])
+        self.assertEqual((link.user_id, link.photo_id), tuple(key))
+
+    def test_get_many_chunks(self):
+        ids = [id for (id,) in self.dba.query(Address.id)]
+        addrs = self.dbp.query(Address).get_many(ids, chunk_size=2)
+        self.assertEqual(sorted(a.email for a in addrs if a is not None),
+                         ['u1a1', 'u1a2', 'u2a2', 'u4a2', 'u5a1'])
+
+
+class StatementCacheTest(DataTestCase):
+
+    FEATURE = 'statement_cache'
+
+    def setUp(self):
+        from statement_cache import StatementCache
+        DataTestCase.setUp(self)
+        self.dbp.close()
+        self.cache = StatementCache(size=2)
+        self.dbp = self.make_sessionmaker(statement_cache=self.cache)()
+
+    def test_statement_cache_hits(self):
+        for name, public in [('u1', True), ('u3', False), ('u5', True),
+                             ('u4', False)]:
+            user = self.dbp.query(User).filter_by(name=name).scalar()
+            self.assertEqual(user is not None and user.name, public and name)
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 3))
+
+    def test_statement_cache_params(self):
+        query = self.dbp.query(User).filter(User.name==bindparam('name'))
+        for name, public in [('u1', True), ('u3', False), ('u1', True)]:
+            user = query.params(name=name).scalar()
+            self.assertEqual(user is not None and user.name, public and name)
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 2))
+
+    def test_statement_cache_size(self):
+        self.dbp.query(User).all()
+        self.dbp.query(Address).all()
+        self.dbp.query(Photo).all()
+        self.assertEqual(len(self.cache), 2)
+        self.dbp.query(User).all()
+        self.assertEqual((self.cache.misses, self.cache.hits), (4, 0))
+
+    def test_statement_cache_invalidate(self):
+        import publicity
+        self.dbp.query(User).all()
+        publicity.invalidate()
+        self.assertEqual(len(self.dbp.query(User).all()), 4)
+        self.assertEqual((self.cache.misses, self.cache.hits), (2, 0))
+
+    def test_statement_cache_audience(self):
+        for audience in [None, 'staff', None, 'staff']:
+            users = self.dbp.query(User).audience(audience).all()
+            self.assertEqual(len(users), 6 if audience else 4)
+        self.assertEqual((self.cache.misses, self.cache.hits), (2, 2))
+
+
+class KeysetPaginationTest(DataTestCase):
+
+    FEATURE = 'page_after'
+
+    def test_page_after(self):
+        users, key = self.dbp.query(User).page_after(None, 3)
+        self.assertEqual([x.name for x in users], ['u1', 'u2', 'u5'])
+        users, key = self.dbp.query(User).page_after(key, 3)
+        self.assertEqual([x.name for x in users], ['u6'])
+        self.assertIsNone(key)
+
+    def test_page_after_exact(self):
+        users, key = self.dbp.query(User).page_after(None, 2)
+        self.assertEqual([x.name for x in users], ['u1', 'u2'])
+        users, key = self.dbp.query(User).page_after(key, 2)
+        self.assertEqual([x.name for x in users], ['u5', 'u6'])
+        users, key = self.dbp.query(User).page_after(key, 2)
+        self.assertEqual((users, key), ([], None))
+
+    def test_page_after_filtered(self):
+        query = self.dbp.query(Address).filter(Address.email.like('u%a2'))
+        emails = []
+        key = None
+        while True:
+            addrs, key = query.page_after(key, 1)
+            emails.extend(a.email for a in addrs)
+            if key is None:
+                break
+        self.assertEqual(emails, ['u1a2', 'u2a2', 'u4a2'])
+
+    def test_page_after_composite(self):
+        all_keys = self.dba.query(User_Photo.user_id, User_Photo.photo_id)\
+                           .order_by(User_Photo.user_id,
+                                     User_Photo.photo_id).all()
+        links, key = self.dbp.query(User_Photo).page_after(None, 3)
+        self.assertEqual(key, all_keys[2])
+        links, key = self.dbp.query(User_Photo).page_after(key, 3)
+        self.assertEqual([(l.user_id, l.photo_id) for l in links],
+                         all_keys[3:6])
+
+    def test_page_after_not_filtered(self):
+        objs, key = self.dbp.query(NotFiltered).page_after(1, 2)
+        self.assertEqual([obj.id for obj in objs], [2, 3])
+        self.assertEqual(key, 3)
+
+
+class StreamTest(DataTestCase):
+
+    FEATURE = 'stream'
+
+    def test_stream(self):
+        batches = list(self.dbp.query(Address).stream(batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual([a.email for batch in batches for a in batch],
+                         ['u1a1', 'u1a2', 'u2a2', 'u4a2', 'u5a1'])
+
+    def test_stream_fields(self):
+        rows = [row for batch in self.dbp.query(User.name).stream(3)
+                for row in batch]
+        self.assertEqual(set(n for (n,) in rows),
+                         set(['u1', 'u2', 'u5', 'u6']))
+
+    def test_stream_joinedload(self):
+        query = self.dbp.query(User).options(joinedload(User.addresses))
+        expected = [(u.name, set(a.email for a in u.addresses))
+                    for u in query.all()]
+        self.dbp.expunge_all()
+        batches = list(query.stream(batch_size=1))
+        self.assertEqual([len(batch) for batch in batches], [1, 1, 1, 1])
+        self.assertEqual([(u.name, set(a.email for a in u.addresses))
+                          for batch in batches for u in batch],
+                         expected)
+
+    def test_stream_joinedload_ordered(self):
+        query = self.dbp.query(User).options(joinedload(User.addresses))
+        self.assertRaises(sa_exc.InvalidRequestError,
+                          query.order_by(User.name).stream)
+        self.assertRaises(sa_exc.InvalidRequestError,
+                          query.limit(2).stream)
+        self.assertRaises(sa_exc.InvalidRequestError,
+                          query.offset(1).stream)
+        # Many-to-one doesn't split rows of the query
+        query = self.dbp.query(Address).options(joinedload(Address.user))\
+                        .order_by(Address.email.desc()).limit(2)
+        self.assertEqual([a.email for batch in query.stream(1)
+                          for a in batch], ['u5a1', 'u4a2'])
+
+
+class ColumnExportTest(DataTestCase):
+
+    FEATURE = 'iter_tuples'
+
+    def test_iter_tuples(self):
+        names = list(self.dbp.query(User.name).order_by(User.id)
+                             .iter_tuples(batch_size=3))
+        self.assertEqual(names, [('u1',), ('u2',), ('u5',), ('u6',)])
+        self.assertEqual(type(names[0]), tuple)
+
+    def test_iter_tuples_join(self):
+        query = self.dbp.query(User.name, Address.email).join(Address.user)
+        self.assertEqual(set(query.iter_tuples(batch_size=2)),
+                         set([('u1', 'u1a1'),
+                              ('u1', 'u1a2'),
+                              ('u2', 'u2a2'),
+                              ('u5', 'u5a1')]))
+
+    def test_iter_tuples_limit(self):
+        query = self.dbp.query(Address.email).order_by(Address.id).limit(3)
+        self.assertEqual(list(query.iter_tuples()),
+                         [('u1a1',), ('u1a2',), ('u2a2',)])
+
+    def test_column_arrays(self):
+        query = self.dbp.query(Address.email, User.name)\
+                        .join(Address.user).order_by(Address.id)
+        self.assertEqual(query.column_arrays(batch_size=2),
+                         [['u1a1', 'u1a2', 'u2a2', 'u5a1'],
+                          ['u1', 'u1', 'u2', 'u5']])
+        query = self.dbp.query(User.name).filter_by(name='u3')
+        self.assertEqual(query.column_arrays(), [[]])
+
+    def test_entities_rejected(self):
+        self.assertRaises(sa_exc.InvalidRequestError,
+                          list, self.dbp.query(User).iter_tuples())
+
+
+class MetricsTest(DataTestCase):
+
+    FEATURE = 'metrics_sink'
+
+    def setUp(self):
+        from metrics import CollectingSink
+        DataTestCase.setUp(self)
+        self.dbp.close()
+        self.sink = CollectingSink()
+        self.dbp = self.make_sessionmaker(metrics_sink=self.sink)()
+
+    def test_metrics(self):
+        self.dbp.query(User.name, Address.email).join(Address.user).all()
+        self.assertEqual(self.sink.total('entities_filtered', 'User'), 2)
+        self.assertEqual(self.sink.total('rows', 'Address'), 4)
+        self.assertEqual(self.sink.count('criteria_time', 'Address'), 1)
+        self.assertEqual(self.sink.count('compile_time', 'User'), 1)
+
+    def test_metrics_bypass(self):
+        # Criteria are injected by limit(), so it's not a bypass
+        self.dbp.query(User).limit(2).all()
+        self.assertEqual(self.sink.count('bypass.limit', 'User'), 0)
+        self.assertEqual(self.sink.count('entities_filtered', 'User'), 1)
+        self.assertEqual(self.sink.total('rows', 'User'), 2)
+        self.dbp.query(User).from_statement('SELECT * FROM user').all()
+        self.assertEqual(self.sink.count('bypass.statement', 'User'), 1)
+
+
+class BatchLoadTest(DataTestCase):
+
+    FEATURE = 'load_all'
+
+    def setUp(self):
+        DataTestCase.setUp(self)
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: self.statements.append(args[2]))
+
+    def test_load_all(self):
+        users = self.dbp.query(User).load_all(User.addresses, User.photos)
+        self.assertEqual(len(self.statements), 3)
+        self.assertEqual(
+            dict((u.name, (set(a.email for a in u.addresses),
+                           set(p.photo for p in u.photos)))
+                 for u in users),
+            {'u1': (set(['u1a1', 'u1a2']), set(['u1p1', 'u1p2'])),
+             'u2': (set(['u2a2']), set(['u2p2'])),
+             'u5': (set(['u5a1']), set(['u5p1'])),
+             'u6': (set(), set())})
+        self.assertEqual(len(self.statements), 3)
+
+    def test_load_all_scalar(self):
+        addrs = self.dbp.query(Address).load_all(Address.user)
+        self.assertEqual(len(self.statements), 2)
+        self.assertEqual(dict((a.email, a.user and a.user.name)
+                              for a in addrs),
+                         {'u1a1': 'u1', 'u1a2': 'u1', 'u2a2': 'u2',
+                          'u4a2': None, 'u5a1': 'u5'})
+        self.assertEqual(len(self.statements), 2)
+
+
+class BulkVisibilityTest(DataTestCase):
+
+    FEATURE = 'set_public'
+
+    def test_set_public(self):
+        counts = self.dbp.query(User).filter(User.name.in_(['u1', 'u3']))\
+                    .set_public(False, cascade=[User.addresses, User.photos])
+        self.assertEqual(counts, {User: 2, Address: 4, Photo: 4})
+        self.assertEqual([u.name for u in self.dbp.query(User)],
+                         ['u2', 'u5', 'u6'])
+        self.assertEqual([a.email for a in self.dbp.query(Address)],
+                         ['u2a2', 'u4a2', 'u5a1'])
+        self.assertEqual(self.dba.query(Photo).filter_by(public=True).count(),
+                         2)
+
+    def test_set_public_publish(self):
+        counts = self.dbp.query(Address).filter_by(email='u3a1')\
+                         .set_public(True, cascade=[Address.user])
+        self.assertEqual(counts, {User: 1, Address: 1})
+        user = self.dbp.query(User).filter_by(name='u3').one()
+        self.assertEqual([a.email for a in user.addresses], ['u3a1'])
+
+    def test_set_public_session(self):
+        user = self.dbp.query(User).filter_by(name='u1').one()
+        self.assertEqual(len(user.addresses), 2)
+        self.dbp.query(Address).filter_by(email='u1a1').set_public(False)
+        self.assertEqual([a.email for a in user.addresses], ['u1a2'])
+        user_id, addr = user.id, user.addresses[0]
+        self.dbp.query(User).filter_by(name='u1').set_public(False)
+        self.assertIsNone(self.dbp.query(User).get(user_id))
+        self.assertIsNone(addr.user)
+
+    def test_set_public_hybrid(self):
+        with self.assertRaises(sa_exc.InvalidRequestError):
+            self.dbp.query(WithAttributeError).set_public(False)
+
+
+class PolymorphicTest(DataTestCase):
+
+    FEATURE = 'polymorphic_criteria'
+
+    def setUp(self):
+        DataTestCase.setUp(self)
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: self.statements.append(args[2]))
+
+    def test_polymorphic(self):
+        docs = self.dbp.query(Doc).order_by(Doc.id).all()
+        self.assertEqual([d.title for d in docs], ['n1', 'a1', 'e1'])
+        self.assertEqual(len(self.statements), 1)
+        # Subclass criterion is checked without loading subclass table
+        self.assertNotIn('JOIN', self.statements[0])
+
+    def test_with_polymorphic(self):
+        docs = self.dbp.query(Doc).with_polymorphic('*')\
+                       .order_by(Doc.id).all()
+        self.assertEqual([(d.title, getattr(d, 'date_start', None))
+                          for d in docs],
+                         [('n1', None), ('a1', 'tomorrow'), ('e1', None)])
+        self.assertTrue(docs[2].approved)
+        self.assertEqual(len(self.statements), 1)
+
+    def test_with_polymorphic_filter(self):
+        docs = self.dbp.query(Doc).with_polymorphic([Announce])\
+                       .filter(or_(Announce.date_start=='today',
+                                   Doc.title.in_(['e1', 'e2'])))
+        self.assertEqual([d.title for d in docs], ['e1'])
+
+    def test_subclass(self):
+        self.assertEqual([d.title for d in self.dbp.query(Event)], ['e1'])
+        self.assertEqual([d.title for d in self.dbp.query(Announce)], ['a1'])
+
+    def test_base_rows(self):
+        # Doc has no polymorphic identity, its rows are filtered by its own
+        # criterion. Columns are queried, since newer SQLAlchemy refuses to
+        # load instance with NULL discriminator.
+        self.dba.add_all([Doc(title='d1', public=True),
+                          Doc(title='d2', public=False)])
+        self.dba.commit()
+        titles = [title for title, in
+                  self.dbp.query(Doc.title).order_by(Doc.id)]
+        self.assertEqual(titles, ['n1', 'a1', 'e1', 'd1'])
+
+
+class VisibilityCacheTest(DataTestCase):
+
+    FEATURE = 'visibility_cache'
+
+    def setUp(self):
+        from visibility_cache import VisibilityCache, MemoryBackend
+        DataTestCase.setUp(self)
+        self.dbp.close()
+        self.now = 0
+        self.backend = MemoryBackend(size=3, ttl=10, clock=lambda: self.now)
+        self.cache = VisibilityCache(self.backend)
+        self.Session = self.make_sessionmaker(visibility_cache=self.cache)
+        self.cache.install(self.Session)
+        self.cache.install(self.dba)
+        self.dbp = self.Session()
+        self.ids = dict(self.dba.query(User.name, User.id))
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: self.statements.append(args[2]))
+
+    def test_get_private(self):
+        self.assertIsNone(self.dbp.query(User).get(self.ids['u3']))
+        self.assertEqual(len(self.statements), 1)
+        db = self.Session()
+        self.assertIsNone(db.query(User).get(self.ids['u3']))
+        self.assertEqual(len(self.statements), 1)
+        self.assertIsNotNone(db.query(User).get(self.ids['u1']))
+        self.assertEqual(len(self.statements), 2)
+
+    def test_get_expired(self):
+        user = self.dbp.query(User).get(self.ids['u1'])
+        self.dbp.expire(user)
+        del self.statements[:]
+        self.assertIs(self.dbp.query(User).get(self.ids['u1']), user)
+        self.assertEqual(self.statements, [])
+
+    def test_lazy_load(self):
+        addr = self.dbp.query(Address).filter_by(email='u4a2').one()
+        self.assertIsNone(addr.user)
+        addr = self.Session().query(Address).filter_by(email='u4a2').one()
+        del self.statements[:]
+        self.assertIsNone(addr.user)
+        self.assertEqual(self.statements, [])
+
+    def test_invalidate(self):
+        self.assertIsNone(self.dbp.query(User).get(self.ids['u3']))
+        user = self.dba.query(User).get(self.ids['u3'])
+        user.public = True
+        self.dba.flush()
+        self.assertIsNone(self.cache.get((User, (self.ids['u3'],))))
+        self.dba.commit()
+        user = self.Session().query(User).get(self.ids['u3'])
+        self.assertEqual(user.name, 'u3')
+
+    def test_rollback(self):
+        user = self.dbp.query(User).audience('staff').get(self.ids['u3'])
+        user.public = True
+        self.dbp.flush()
+        # Loaded from database, where it's public in this transaction only
+        self.dbp.expire(user)
+        self.assertIs(self.dbp.query(User).get(self.ids['u3']), user)
+        self.assertIsNone(self.cache.get((User, (self.ids['u3'],))))
+        self.dbp.rollback()
+        self.assertIsNone(self.dbp.query(User).get(self.ids['u3']))
+        self.assertIsNone(self.Session().query(User).get(self.ids['u3']))
+
+    def test_lru_ttl(self):
+        for name in ['u3', 'u4', 'u1', 'u3', 'u2']:
+            self.dbp.query(User).get(self.ids[name])
+        self.assertIsNone(self.cache.get((User, (self.ids['u4'],))))
+        self.assertIs(self.cache.get((User, (self.ids['u3'],))), False)
+        self.now = 10
+        self.assertIsNone(self.cache.get((User, (self.ids['u3'],))))
+
+    def test_sqlite_backend(self):
+        import os, tempfile
+        from visibility_cache import SQLiteBackend
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            backends = [SQLiteBackend(path, size=2, ttl=10,
+                                      clock=lambda: self.now)
+                        for i in range(2)]
+            backends[0].set('User:1', True)
+            backends[0].set('User:2', False)
+            self.assertIs(backends[1].get('User:2'), False)
+            backends[1].set('User:3', False)
+            self.assertIsNone(backends[0].get('User:1'))
+            backends[1].delete_many(['User:2'])
+            self.assertIsNone(backends[0].get('User:2'))
+            self.now = 10
+            self.assertIsNone(backends[0].get('User:3'))
+        finally:
+            os.remove(path)
+
+
+class AudienceTest(DataTestCase):
+
+    FEATURE = 'audience'
+
+    def test_session_audience(self):
+        # Session.info is missing in older SQLAlchemy
+        self.dbp.info = {'audience': 'staff'}
+        self.assertEqual(self.dbp.query(User).count(), 6)
+        self.dbp.info = {'audience': 'members'}
+        names = [u.name for u in self.dbp.query(User)]
+        self.assertEqual(names, ['u1', 'u2', 'u5', 'u6'])
+        self.assertEqual(self.dbp.query(Address).count(), 12)
+
+    def test_query_audience(self):
+        query = self.dbp.query(Address).filter(Address.email.like('u3%'))
+        self.assertEqual(query.count(), 0)
+        emails = [a.email for a in query.audience('members')]
+        self.assertEqual(emails, ['u3a1', 'u3a2'])
+
+    def test_get(self):
+        ids = dict(self.dba.query(User.name, User.id))
+        self.assertIsNone(self.dbp.query(User).get(ids['u3']))
+        user = self.dbp.query(User).audience('staff').get(ids['u3'])
+        self.assertEqual(user.name, 'u3')
+        # Instance from identity map is checked for audience of query
+        self.assertIsNone(self.dbp.query(User).get(ids['u3']))
+
+    def test_lazy_load(self):
+        self.dbp.info = {'audience': 'members'}
+        user = self.dbp.query(User).filter_by(name='u2').one()
+        self.assertEqual(sorted(a.email for a in user.addresses),
+                         ['u2a1', 'u2a2'])
+
+    def test_unknown_audience(self):
+        self.assertRaises(ValueError,
+                          self.dbp.query(User).audience('nobody').all)
+
+
+# Tests for optional features, run when query class provides FEATURE
+FEATURE_TESTS = [GetManyTest, StatementCacheTest, KeysetPaginationTest,
+                 StreamTest, ColumnExportTest, MetricsTest, BatchLoadTest,
+                 VisibilityCacheTest, BulkVisibilityTest, PolymorphicTest,
+                 AudienceTest]
+
+
+def make_suite(query_cls):
+    DataTestCase.QUERY_CLS = query_cls
+    loader = unittest.TestLoader()
+    suite = loader.loadTestsFromTestCase(UserAddressesTest)
+    suite.addTests(loader.loadTestsFromTestCase(EffectivePublicityTest))
+    suite.addTests(loader.loadTestsFromTestCase(RegistryTest))
+    for test_case in FEATURE_TESTS:
+        if hasattr(query_cls, test_case.FEATURE):
+            suite.addTests(loader.loadTestsFromTestCase(test_case))
+    return suite
+
+
 def run_test(query_cls):
-    UserAddressesTest.QUERY_CLS = query_cls
-    suite = unittest.TestLoader().loadTestsFromTestCase(UserAddressesTest)
-    unittest.TextTestRunner().run(suite)
+    unittest.TextTestRunner().run(make_suite(query_cls))
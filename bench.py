@@ -0,0 +1,248 @@
+#!/usr/bin/python
+'''
+Performance comparison of PublicQuery implementations on models from base.py.
+
+For each dataset size and public ratio SQLite database is generated once and
+each scenario is run with each strategy (providing optional features it
+uses) in a fresh session. Results are written as JSON lines, one per
+(strategy, scenario, size, public ratio):
+
+    wall_time       median time of full scenario (build, execute, load)
+    construct_time  median time to build filtered query and compile it
+                    (statement cache is not used here)
+    statements      number of SQL statements emitted by one run
+    error           exception if strategy failed the scenario
+
+Usage:
+
+    python bench.py --sizes 1000,10000 --ratios 0.1,0.5,0.9 > bench.jsonl
+'''
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, joinedload
+from base import Base, User, Address, Photo, User_Photo
+
+
+def _strategies():
+    import recipe, combined, stm_old
+    from statement_cache import StatementCache
+
+    class CachedPublicQuery(combined.PublicQuery):
+        statement_cache = StatementCache()
+
+    return OrderedDict([
+        ('recipe', recipe.PublicQuery),
+        ('combined', combined.PublicQuery),
+        ('combined_cached', CachedPublicQuery),
+        ('stm_old', stm_old.PublicQuery),
+    ])
+
+
+def populate(engine, size, public_ratio, seed=0, chunk_size=10000):
+    '''Creates size users with two addresses and two photos each. Each object
+    is public with public_ratio probability.'''
+    rnd = random.Random(seed)
+    Base.metadata.create_all(engine)
+    tables = [User.__table__, Address.__table__, Photo.__table__,
+              User_Photo.__table__]
+    with engine.begin() as conn:
+        for start in range(0, size, chunk_size):
+            rows = dict((table, []) for table in tables)
+            for user_id in range(start+1, min(start+chunk_size, size)+1):
+                rows[User.__table__].append(
+                    {'id': user_id, 'name': 'u%d' % user_id,
+                     'public': rnd.random()<public_ratio})
+                for i in (1, 2):
+                    obj_id = user_id*2-2+i
+                    rows[Address.__table__].append(
+                        {'id': obj_id, 'email': 'u%da%d' % (user_id, i),
+                         'user_id': user_id,
+                         'public': rnd.random()<public_ratio})
+                    rows[Photo.__table__].append(
+                        {'id': obj_id, 'photo': 'u%dp%d' % (user_id, i),
+                         'public': rnd.random()<public_ratio})
+                    rows[User_Photo.__table__].append(
+                        {'user_id': user_id, 'photo_id': obj_id})
+            for table in tables:
+                conn.execute(table.insert(), rows[table])
+
+
+# Scenarios return query and function consuming it. Data dictionary has
+# "size" and "ids" (random sample of user ids) items.
+SCENARIOS = OrderedDict()
+
+def scenario(func):
+    SCENARIOS[func.__name__[len('bench_'):]] = func
+    return func
+
+def requires(feature):
+    '''Marks scenario using optional feature (name of PublicQuery attribute,
+    as FEATURE of tests in base.py), it's skipped for strategies without
+    it.'''
+    def decorator(func):
+        func.feature = feature
+        return func
+    return decorator
+
+@scenario
+def bench_iter(db, data):
+    return db.query(Address), list
+
+@scenario
+def bench_iter_fields(db, data):
+    return db.query(User.name, Address.email).join(Address.user), list
+
+@scenario
+@requires('iter_tuples')
+def bench_export_fields(db, data):
+    return db.query(User.name, Address.email).join(Address.user), \
+           lambda query: list(query.iter_tuples())
+
+@scenario
+def bench_count(db, data):
+    return db.query(Address), lambda query: query.count()
+
+@scenario
+def bench_get(db, data):
+    return db.query(User), \
+           lambda query: [query.get(user_id) for user_id in data['ids']]
+
+@scenario
+def bench_join(db, data):
+    emails = ['u%da1' % user_id for user_id in data['ids']]
+    return db.query(User).join(User.addresses)\
+                         .filter(Address.email.in_(emails)), list
+
+@scenario
+def bench_relation(db, data):
+    return db.query(User).filter(User.id.in_(data['ids'])), \
+           lambda query: [(len(u.addresses), len(u.photos)) for u in query]
+
+@scenario
+def bench_joinedload(db, data):
+    return db.query(User).filter(User.id.in_(data['ids']))\
+                         .options(joinedload(User.addresses)), list
+
+@scenario
+def bench_slice(db, data):
+    start = data['size']//4
+    return db.query(User), lambda query: query[start:start+50]
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+
+def _construct(db, scenario_func, data):
+    query, consume = scenario_func(db, data)
+    if hasattr(query, 'private'):
+        query = query.private()
+    context = query._compile_context()
+    context.statement.use_labels = True
+    context.statement.compile(db.bind)
+
+
+def run_scenario(engine, query_cls, scenario_func, data, repeat):
+    statements = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda *args: statements.append(1))
+    Session = sessionmaker(bind=engine, query_cls=query_cls)
+    wall_times = []
+    construct_times = []
+    counts = []
+    try:
+        for i in range(repeat):
+            db = Session()
+            try:
+                started = timer()
+                _construct(db, scenario_func, data)
+                construct_times.append(timer()-started)
+                del statements[:]
+                started = timer()
+                query, consume = scenario_func(db, data)
+                consume(query)
+                wall_times.append(timer()-started)
+                counts.append(len(statements))
+            finally:
+                db.close()
+    finally:
+        # There is no event.remove() in older versions, so we just clear
+        # whole listeners collection.
+        engine.dispatch.before_cursor_execute.clear()
+    return {'wall_time': _median(wall_times),
+            'construct_time': _median(construct_times),
+            'statements': max(counts)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated numbers of users')
+    parser.add_argument('--ratios', default='0.1,0.5,0.9',
+                        help='comma separated ratios of public objects')
+    parser.add_argument('--strategies', default=None,
+                        help='comma separated strategies (all by default)')
+    parser.add_argument('--scenarios', default=None,
+                        help='comma separated scenarios (all by default)')
+    parser.add_argument('--sample', type=int, default=100,
+                        help='number of ids used by get, join etc.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None,
+                        help='file to write results to (stdout by default)')
+    args = parser.parse_args(argv)
+
+    strategies = _strategies()
+    if args.strategies:
+        strategies = OrderedDict((name, strategies[name])
+                                 for name in args.strategies.split(','))
+    scenarios = SCENARIOS
+    if args.scenarios:
+        scenarios = OrderedDict((name, SCENARIOS[name])
+                                for name in args.scenarios.split(','))
+    output = open(args.output, 'w') if args.output else sys.stdout
+
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for ratio in [float(r) for r in args.ratios.split(',')]:
+            fd, path = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            try:
+                engine = create_engine('sqlite:///' + path)
+                populate(engine, size, ratio)
+                rnd = random.Random(size)
+                data = {'size': size,
+                        'ids': rnd.sample(range(1, size+1),
+                                          min(args.sample, size))}
+                for strategy, query_cls in strategies.items():
+                    for name, scenario_func in scenarios.items():
+                        feature = getattr(scenario_func, 'feature', None)
+                        if feature is not None and \
+                                not hasattr(query_cls, feature):
+                            continue
+                        result = OrderedDict([
+                            ('strategy', strategy), ('scenario', name),
+                            ('size', size), ('public_ratio', ratio)])
+                        try:
+                            result.update(run_scenario(
+                                    engine, query_cls, scenario_func, data,
+                                    args.repeat))
+                        except Exception as exc:
+                            result['error'] = repr(exc)
+                        output.write(json.dumps(result) + '\n')
+                        output.flush()
+                engine.dispose()
+            finally:
+                os.remove(path)
+
+
+if __name__=='__main__':
+    main()
@@ -1,9 +1,22 @@
 #!/usr/bin/python
 
-from sqlalchemy.orm.query import Query
-from sqlalchemy.sql import ClauseElement
-from sqlalchemy import cast, Boolean
+from itertools import islice
+from timeit import default_timer as time
+from sqlalchemy.orm.query import Query, _ColumnEntity, _generative
+from sqlalchemy import and_, or_, func, select, util
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.orm import attributes, mapperlib
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+from sqlalchemy.orm.exc import UnmappedError
+from sqlalchemy.orm.mapper import Mapper
 from sqlalchemy.orm.util import _class_to_mapper
+from sqlalchemy.schema import Table, Column
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.expression import _Exists, _BindParamClause, Alias
+from sqlalchemy.sql.util import ClauseAdapter
+from publicity import entity_criterion, polymorphic_criterion, \
+                      instance_publicity, generation, NOT_FILTERED
+from loading import selectin_load, _relationship_plan
 
 
 class PublicQuery(Query):
@@ -15,95 +28,684 @@ class PublicQuery(Query):
     the class and boolean (convertable to boolean) value for instance of the
     class.
 
+    Criteria of other audience (see publicity.register_audience()) are
+    applied when session has info = {'audience': name} or query is narrowed
+    with audience(). Lazy loads use audience of session.
+
     A version from recipe combined with our own vision
     http://www.sqlalchemy.org/trac/wiki/UsageRecipes/PreFilteredQuery
     '''
 
+    # Only public rows are selected, so reads can go to replicas (see
+    # replicas.py)
+    reads_public = True
+
+    def __init__(self, entities, session=None):
+        Query.__init__(self, entities, session)
+        # Stored in query, so that statement cache keys include it. Session
+        # has no "info" before SQLAlchemy 0.9, it has to be set manually.
+        info = getattr(session, 'info', None) or {}
+        self._audience = info.get('audience')
+
+    @_generative()
+    def audience(self, name):
+        '''Applies publicity criteria of named audience instead of the one
+        of session.'''
+        self._audience = name
+
+    def _ident(self, mapper, ident, method):
+        # convert composite types to individual args
+        if hasattr(ident, '__composite_values__'):
+            ident = ident.__composite_values__()
+        ident = tuple(util.to_list(ident))
+        if len(ident)!=len(mapper.primary_key):
+            raise sa_exc.InvalidRequestError(
+                "Incorrect number of values in identifier to formulate "
+                "primary key for query.%s(); primary key columns are %s" % (
+                    method,
+                    ','.join("'%s'" % c for c in mapper.primary_key)))
+        return ident
+
+    def _coerce_ident(self, mapper, ident):
+        # Database coerces values compared to columns (e.g. '1' finds row
+        # with id 1), so that get() finds it. Values are coerced the same
+        # way to match identity keys of loaded instances.
+        values = []
+        for col, value in zip(mapper.primary_key, ident):
+            try:
+                python_type = col.type.python_type
+            except NotImplementedError:
+                python_type = None
+            if python_type is not None and value is not None and \
+                    not isinstance(value, python_type):
+                try:
+                    value = python_type(value)
+                except (TypeError, ValueError, UnicodeError):
+                    pass
+            values.append(value)
+        return tuple(values)
+
+    def _identity_map_usable(self, mapper):
+        # Identity map can be trusted only when there is no other criterion:
+        # we can't check it in Python.
+        return self._criterion is None and not self._populate_existing and \
+               not mapper.always_refresh and self._lockmode is None
+
     def get(self, ident):
-        if self._criterion:
-            mapper = self._only_full_mapper_zero("get")
-            # Don't use getattr/hasattr to check public existence, since this
-            # might misinterpret a bug (AttributeError raised by some code in
-            # property implementation) as missing attribute and cause all
-            # private data going to public.
-            if 'public' in dir(mapper.class_):
-                crit = mapper.class_.public
-                if crit is not None:
-                    if not isinstance(crit, ClauseElement):
-                        # This simplest safe way to make bare boolean column
-                        # accepted as expression.
-                        crit = cast(crit, Boolean)
-                    if crit!=self._criterion:
-                        # We can't verify that criterion is from our private()
-                        # call.  Check from DB instead of looking in identity
-                        # map.
-                        assert False # XXX temporal to verify it's used
-                        return Query.get(self.populate_existing(), ident)
-            assert False # XXX temporal to verify it's used
-        obj = Query.get(self, ident)
-        if obj is not None and ('public' not in dir(obj) or obj.public):
-            return obj
+        '''
+        Instance present in identity map is checked by its loaded "public"
+        value, database is queried (with criterion) only when it's expired
+        or not loaded.
+        '''
+        mapper = self._only_full_mapper_zero("get")
+        key = mapper.identity_key_from_primary_key(
+                                    self._ident(mapper, ident, "get"))
+        if self._identity_map_usable(mapper):
+            obj = self.session.identity_map.get(key)
+            if obj is not None:
+                if not isinstance(obj, mapper.class_):
+                    return None
+                public = None
+                if not attributes.instance_state(obj).expired:
+                    public = instance_publicity(obj, self._audience)
+                if public is None and self.visibility_cache is not None:
+                    public = self.visibility_cache.get(key, self._audience)
+                if public is not None:
+                    return obj if public else None
+        # Raises for query with criterion as Query.get() does
+        return self._load_on_ident(key)
+
+    # visibility_cache.VisibilityCache instance to skip loading of objects
+    # known to be private
+    visibility_cache = None
+
+    def _load_on_ident(self, key, refresh_state=None, lockmode=None,
+                       only_load_props=None):
+        # Used by get() and many-to-one lazy loads
+        cache = self.visibility_cache
+        if cache is None or refresh_state is not None or \
+                self._criterion is not None:
+            return Query._load_on_ident(self, key, refresh_state, lockmode,
+                                        only_load_props)
+        visible = cache.get(key, self._audience)
+        if visible is False:
+            return None
+        obj = Query._load_on_ident(self, key, lockmode=lockmode,
+                                   only_load_props=only_load_props)
+        if visible is None:
+            cache.set(key, obj is not None, self._audience, self.session)
+        return obj
+
+    def get_many(self, idents, chunk_size=400):
+        '''
+        Batched version of get(). Returns list of instances in the order of
+        idents with None for missing and private ones. Public instances
+        present in identity map are returned without querying, all the rest
+        are loaded with "WHERE pk IN (...)" queries of at most chunk_size
+        identifiers each.
+        '''
+        mapper = self._only_full_mapper_zero("get_many")
+        pk = mapper.primary_key
+        keys = [mapper.identity_key_from_primary_key(self._coerce_ident(
+                            mapper, self._ident(mapper, ident, "get_many")))
+                for ident in idents]
+        found = {}
+        missing = []
+        for key in keys:
+            if key in found or None in key[1]:
+                continue
+            obj = public = None
+            if self._identity_map_usable(mapper):
+                obj = self._get_from_identity(self.session, key,
+                                              attributes.PASSIVE_NO_FETCH)
+            if obj is not None and obj is not attributes.PASSIVE_NO_RESULT:
+                if not isinstance(obj, mapper.class_):
+                    found[key] = None
+                    continue
+                public = instance_publicity(obj, self._audience)
+            if public is None:
+                missing.append(key[1])
+            else:
+                found[key] = obj if public else None
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start+chunk_size]
+            if len(pk)==1:
+                cond = pk[0].in_([ident[0] for ident in chunk])
+            else:
+                # Tuple IN is not supported by all backends
+                cond = or_(*[and_(*[col==value
+                                    for col, value in zip(pk, ident)])
+                             for ident in chunk])
+            for obj in self.filter(cond):
+                found[attributes.instance_state(obj).key] = obj
+        return [found.get(key) for key in keys]
+
+    # statement_cache.StatementCache instance to reuse compiled statements
+    statement_cache = None
+    # Callable receiving metrics (see metrics module)
+    metrics_sink = None
 
     def __iter__(self):
-        return Query.__iter__(self.private())
+        sink = self.metrics_sink
+        if self.statement_cache is not None:
+            results = self.statement_cache.execute(self)
+        elif sink is not None:
+            results = self._instrumented_iter(sink)
+        else:
+            return Query.__iter__(self.private())
+        if sink is None:
+            return results
+        return self._count_rows(results, sink)
+
+    def _instrumented_iter(self, sink):
+        # Does the same as Query.__iter__(), but compiles statement
+        # separately to measure time spent.
+        query = self.private()
+        context = query._compile_context()
+        context.statement.use_labels = True
+        if query._autoflush and not query._populate_existing:
+            query.session._autoflush()
+        conn = query._connection_from_session(
+                        mapper=query._mapper_zero_or_none(),
+                        clause=context.statement,
+                        close_with_result=True)
+        started = time()
+        compiled = context.statement.compile(dialect=conn.dialect)
+        sink('compile_time', time()-started, query._mapped_classes())
+        result = conn.execute(compiled, query._params)
+        return query.instances(result, context)
+
+    def _count_rows(self, results, sink):
+        count = 0
+        try:
+            for row in results:
+                count += 1
+                yield row
+        finally:
+            sink('rows', count, self._mapped_classes())
+
+    def _mapped_classes(self, entities=None):
+        if entities is None:
+            entities = [entity for query_entity in self._entities
+                        for entity in query_entity.entities]
+        names = set()
+        for entity in entities:
+            try:
+                names.add(_class_to_mapper(entity).class_.__name__)
+            except UnmappedError:
+                pass
+        return tuple(sorted(names))
 
     def from_self(self, *ent):
         # override from_self() to automatically apply
         # the criterion too.   this works with count() and
         # others.
-        return Query.from_self(self.private(), *ent)
+        query = Query.from_self(self.private(), *ent)
+        # LIMIT and OFFSET are inside subquery now
+        query._limited_after_criteria = False
+        return query
 
     def count(self):
         # Without it it works with slow implementation of count(), while
         # we often use a faster one from older version.
-        return Query.count(self.private())
+        query = self.private()
+        if query._count_wrapped():
+            # Number of rows depends on the whole query, so it has to be
+            # wrapped.  Criteria are already applied inside, outer select
+            # is not a query, so it's not filtered once more.
+            statement = select([func.count()])\
+                            .select_from(query.with_labels().statement.alias())
+        else:
+            statement = query._flat_count_statement()
+        if query._autoflush:
+            query.session._autoflush()
+        return query.session.execute(
+                    statement, query._params,
+                    mapper=query._mapper_zero_or_none()).scalar()
+
+    def _count_wrapped(self):
+        return self._statement is not None or self._distinct \
+               or self._group_by or self._having is not None \
+               or self._limit is not None or self._offset is not None
+
+    def _flat_count_statement(self):
+        # Flat "SELECT count(*) ... WHERE <criterion>" counts the same rows
+        # as the query itself without subquery.
+        context = self.enable_eagerloads(False)._compile_context()
+        statement = context.statement
+        froms = statement.froms
+        statement = statement.with_only_columns([func.count()])\
+                             .order_by(None)
+        for from_ in froms:
+            statement = statement.select_from(from_)
+        return statement
+
+    def _limited(self, method, *args):
+        query = method(self.private(), *args)
+        query._limited_after_criteria = True
+        return query
 
     def slice(self, start, stop):
-        return Query.slice(self.private(), start, stop)
+        query = Query.slice(self, start, stop)
+        if query._limit is None and query._offset is None:
+            # Nothing is limited, criteria are injected on iteration
+            return query
+        return self._limited(Query.slice, start, stop)
 
     def limit(self, limit):
-        return Query.limit(self.private(), limit)
+        return self._limited(Query.limit, limit)
 
     def offset(self, offset):
-        return Query.offset(self.private(), offset)
+        return self._limited(Query.offset, offset)
 
-    def _add_entity_criterion(self, entity):
-        #if hasattr(entity, "property"):
-        #    entity = entity.property.mapper
-        if hasattr(entity, 'parententity'):
-            entity = entity.parententity
+    def page_after(self, last_key, size):
+        '''
+        Keyset (seek) pagination: returns list of at most size items
+        following the one with primary key last_key (None for the first
+        page) in primary key order, and a key to pass for the next page (None
+        when there are no more items). Unlike offset() the cost of page
+        doesn't depend on its depth.
+        '''
+        if self._order_by:
+            raise sa_exc.InvalidRequestError(
+                        "Query.page_after() orders by primary key and can't "
+                        "be called on a Query with existing ORDER BY")
+        mapper = self._only_full_mapper_zero("page_after")
+        pk = mapper.primary_key
+        query = self
+        if last_key is not None:
+            last_key = util.to_list(last_key)
+            # (a, b) > (x, y)  =>  a > x OR a = x AND b > y
+            # Row values are not supported by all backends.
+            terms = []
+            for i, col in enumerate(pk):
+                terms.append(and_(*[c==v for c, v in zip(pk[:i], last_key)]
+                                  + [col>last_key[i]]))
+            query = query.filter(or_(*terms))
+        items = query.order_by(*pk).limit(size).all()
+        if not items or len(items)<size:
+            return items, None
+        next_key = mapper.primary_key_from_instance(items[-1])
+        if len(pk)==1:
+            return items, next_key[0]
+        return items, tuple(next_key)
+
+    def load_all(self, *attributes):
+        '''
+        Returns all() results with given relationships loaded for all of
+        them with a query per relationship (see loading.selectin_load())
+        instead of lazy loading for each instance.
+        '''
+        items = self.all()
+        if items:
+            self._only_full_mapper_zero("load_all")
+            for attribute in attributes:
+                selectin_load(items, attribute)
+        return items
+
+    def stream(self, batch_size=1000):
+        '''
+        Iterates over results in lists of at most batch_size items without
+        loading them all into memory. Rows are fetched in batches with
+        server-side cursor where dialect supports it. Joined eager loading of
+        collections can't be combined with it (a collection might be split
+        between batches), so such queries are paginated with page_after()
+        instead and can't have ORDER BY, LIMIT or OFFSET.
+        '''
+        query = self.private()
+        if query._compile_context().multi_row_eager_loaders:
+            if self._order_by or self._limit is not None or \
+                    self._offset is not None:
+                raise sa_exc.InvalidRequestError(
+                            "Query.stream() with joined eager loading of "
+                            "collections orders by primary key and can't be "
+                            "called on a Query with ORDER BY, LIMIT or "
+                            "OFFSET")
+            return self._stream_pages(batch_size)
+        return self._stream_results(query, batch_size)
+
+    def _stream_pages(self, batch_size):
+        key = None
+        while True:
+            items, key = self.page_after(key, batch_size)
+            if items:
+                yield items
+            if key is None:
+                break
+
+    def _stream_results(self, query, batch_size):
+        query = query.execution_options(stream_results=True)\
+                     .yield_per(batch_size)
+        # Criterion is already applied, so we don't call our __iter__()
+        results = Query.__iter__(query)
+        while True:
+            items = list(islice(results, batch_size))
+            if not items:
+                break
+            yield items
+
+    def _column_result(self, method):
+        # Executes query of columns only as Core statement, bypassing ORM
+        # row processing.
+        for query_entity in self._entities:
+            if not isinstance(query_entity, _ColumnEntity):
+                raise sa_exc.InvalidRequestError(
+                            "Query.%s() is for queries of columns only, "
+                            "got %s" % (method, query_entity))
+        query = self.private()
+        if query._autoflush and not query._populate_existing:
+            query.session._autoflush()
+        statement = query.statement.execution_options(stream_results=True)
+        return query.session.execute(statement,
+                                     mapper=query._mapper_zero_or_none())
+
+    def _column_batches(self, method, batch_size):
+        sink = self.metrics_sink
+        result = self._column_result(method)
+        count = 0
+        try:
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                count += len(rows)
+                yield rows
+        finally:
+            result.close()
+            if sink is not None:
+                sink('rows', count, self._mapped_classes())
+
+    def iter_tuples(self, batch_size=1000):
+        '''
+        Fast path for bulk export of column-only queries (e.g.
+        query(User.name, Address.email)): iterates over plain tuples of
+        values fetched in batches of batch_size rows, without ORM row
+        processing.
+        '''
+        for rows in self._column_batches("iter_tuples", batch_size):
+            for row in rows:
+                yield tuple(row)
+
+    def column_arrays(self, batch_size=1000):
+        '''
+        The same as iter_tuples(), but returns list of values for each
+        column.
+        '''
+        arrays = [[] for entity in self._entities]
+        for rows in self._column_batches("column_arrays", batch_size):
+            for array, values in zip(arrays, zip(*rows)):
+                array.extend(values)
+        return arrays
+
+    def set_public(self, public, cascade=(), synchronize_session='fetch'):
+        '''
+        Publishes (public=True) or hides all objects matched by the query,
+        regardless of their current publicity, with single UPDATE. Targets
+        of relationships listed in cascade (e.g. User.addresses) are updated
+        too, one UPDATE per relationship. Publicity must be a plain column
+        for all updated classes.
+
+        Matched instances in session are expired by default, other values of
+        synchronize_session are passed to Query.update(). Loaded
+        relationships to updated classes are expired too (unless
+        synchronize_session is False), so that filtered reads in the session
+        don't return stale collections.
+        Returns dictionary mapping updated classes to numbers of rows.
+        '''
+        mapper = self._only_full_mapper_zero("set_public")
+        if self._autoflush:
+            self.session._autoflush()
+        counts = {}
+        updated = [mapper]
+        # Related rows first, since criterion might depend on publicity
+        for attribute in cascade:
+            prop = attribute.property
+            if not mapper.isa(prop.parent):
+                raise sa_exc.InvalidRequestError(
+                            "%s is not a relationship of %s" % (prop, mapper))
+            query = Query(prop.mapper, self.session)\
+                        .filter(_related_criterion(prop, self))
+            count = _update_public(query, prop.mapper, public,
+                                   synchronize_session)
+            counts[prop.mapper.class_] = \
+                        counts.get(prop.mapper.class_, 0) + count
+            updated.append(prop.mapper)
+        count = _update_public(self, mapper, public, synchronize_session)
+        counts[mapper.class_] = counts.get(mapper.class_, 0) + count
+        if synchronize_session is not False:
+            _expire_relationships(self.session, updated)
+        return counts
+
+    # Apply criteria of subclasses to rows of their types for polymorphic
+    # entities. Set to False when subclasses don't override publicity, to
+    # skip checking it.
+    polymorphic_criteria = True
+
+    # Set by limit(), offset() and slice(), which inject criteria just before
+    # setting LIMIT and OFFSET, so that private() doesn't report them as
+    # bypass
+    _limited_after_criteria = False
+
+    def _entity_criterion(self, entity, loaded=None):
+        # loaded is a list of mappers loaded with with_polymorphic()
         try:
-            cls = _class_to_mapper(entity).class_
-        except AttributeError:
+            if self.polymorphic_criteria and isinstance(entity, Mapper) and \
+                    entity.polymorphic_on is not None:
+                if loaded is None:
+                    loaded = entity._with_polymorphic_mappers
+                return polymorphic_criterion(entity, loaded, self._audience)
+            return entity_criterion(entity, self._audience)
+        except UnmappedError:
             # XXX For tables, table columns
-            #pass
+            #return NOT_FILTERED
             raise # XXX temporal, to verify it's used
-        else:
-            if 'public' in dir(cls):
-                crit = cls.public
-                if crit is not None:
-                    if not isinstance(crit, ClauseElement):
-                        # This simplest safe way to make bare boolean column
-                        # accepted as expression.
-                        crit = cast(crit, Boolean)
-                    return self.filter(crit)
-        return self
 
     def private(self):
+        sink = self.metrics_sink
         if self._limit is not None or self._offset is not None \
                 or self._statement is not None:
             # Conditions must be added just before setting LIMIT and OFFSET
             # Calling it with statement means from_statement was used: either
             # manually (it's your problem) or by load_scalar_attributes (no
             # need in filtering here).
+            if sink is not None:
+                if self._statement is not None:
+                    reason = 'statement'
+                elif self._limited_after_criteria:
+                    reason = None
+                elif self._limit is not None:
+                    reason = 'limit'
+                else:
+                    reason = 'offset'
+                if reason is not None:
+                    sink('bypass.' + reason, 1, self._mapped_classes())
             return self
-        query = self
+        if sink is not None:
+            started = time()
+        entities = []
         for query_entity in self._entities:
-            for entity in query_entity.entities:
-                query = query._add_entity_criterion(entity)
-        for entity in self._join_entities:
-            query = query._add_entity_criterion(entity)
-        return query
+            if getattr(query_entity, 'is_aliased_class', True):
+                entities.extend((entity, None)
+                                for entity in query_entity.entities)
+            else:
+                entities.append((query_entity.mapper,
+                                 query_entity._with_polymorphic))
+        entities.extend((entity, None) for entity in self._join_entities)
+        # Collect criteria first and filter once: each filter() call clones
+        # the query, and the same class may participate several times.
+        seen = set()
+        criteria = []
+        for entity, loaded in entities:
+            crit = self._entity_criterion(entity, loaded)
+            # Clauses overload ==, so compare identities
+            if crit is not NOT_FILTERED and id(crit) not in seen:
+                seen.add(id(crit))
+                criteria.append(crit)
+        if sink is not None:
+            classes = self._mapped_classes([entity for entity, loaded
+                                            in entities])
+            sink('criteria_time', time()-started, classes)
+            sink('entities_filtered', len(criteria), classes)
+        query = self
+        if self._criterion is not None:
+            criterion = self._criterion_exists_filtered()
+            if criterion is not self._criterion:
+                query = self._clone()
+                query._criterion = criterion
+        if not criteria:
+            return query
+        return query.filter(and_(*criteria))
+
+    # (criterion, table criteria, criterion with EXISTS filtered), shared
+    # by clones with the same criterion, so that it's traversed once
+    _exists_filtered = (None, None, None)
+
+    def _criterion_exists_filtered(self):
+        table_criteria = self._table_criteria()
+        criterion, tables, filtered = self._exists_filtered
+        if criterion is not self._criterion or tables is not table_criteria:
+            filtered = _filter_exists(self._criterion, table_criteria)
+            self._exists_filtered = self._criterion, table_criteria, filtered
+        return filtered
+
+    def _table_criteria(self):
+        # Table -> criterion (or exception raised while building it) of
+        # mapper selecting from it, for criteria referring to that table
+        # only. Used for tables in EXISTS subqueries.
+        global _table_criteria
+        if _table_criteria[0]!=generation():
+            _table_criteria = generation(), {}
+        key = self._audience, self.polymorphic_criteria
+        table_criteria = _table_criteria[1].get(key)
+        if table_criteria is None:
+            table_criteria = _table_criteria[1][key] = {}
+            for mapper in list(mapperlib._mapper_registry):
+                table = mapper.local_table
+                if not isinstance(table, Table) or \
+                        mapper.inherits is not None and \
+                        mapper.inherits.local_table is table:
+                    continue
+                try:
+                    crit = self._entity_criterion(mapper, ())
+                except Exception as exc:
+                    table_criteria[table] = exc
+                    continue
+                if crit is not NOT_FILTERED and \
+                        _outer_tables(crit)==set([table]):
+                    table_criteria[table] = crit
+        return table_criteria
+
+
+# (registry generation, {(audience, polymorphic_criteria): table criteria})
+_table_criteria = (None, {})
+
+
+def _outer_tables(crit):
+    # Tables of columns in criterion except ones in subqueries
+    tables = set()
+    stack = [crit]
+    while stack:
+        elem = stack.pop()
+        if isinstance(elem, Column):
+            tables.add(elem.table)
+        elif elem.__visit_name__!='select':
+            stack.extend(elem.get_children())
+    return tables
+
+
+def _filter_exists(criterion, table_criteria):
+    # Relationship comparators any() and has() build correlated EXISTS
+    # selecting from target table or its alias, criterion of the table is
+    # put inside, so that database can use semi-join.
+    if not any(isinstance(elem, _Exists)
+               for elem in visitors.iterate(criterion, {})):
+        return criterion
+    elems = list(visitors.iterate(criterion, {}))
+    # Leave parameters as is, statement cache maps values to them
+    opts = {'stop_on': [elem for elem in elems
+                        if isinstance(elem, _BindParamClause)]}
+    def replace(elem):
+        if not isinstance(elem, _Exists):
+            return None
+        select = elem.element
+        while hasattr(select, 'element'):
+            select = select.element
+        criteria = []
+        for from_ in select.froms:
+            if isinstance(from_, Alias):
+                crit = table_criteria.get(from_.element._deannotate())
+                if crit is not None and not isinstance(crit, Exception):
+                    crit = ClauseAdapter(from_).traverse(crit)
+            else:
+                crit = table_criteria.get(from_)
+            if isinstance(crit, Exception):
+                raise crit
+            if crit is not None:
+                criteria.append(crit)
+        exists = elem._clone()
+        exists.element = visitors.replacement_traverse(elem.element, opts,
+                                                       replace)
+        if criteria:
+            exists = exists.where(and_(*criteria))
+        return exists
+    return visitors.replacement_traverse(criterion, opts, replace)
+
+
+def _update_public(query, mapper, public, synchronize_session):
+    prop = mapper.get_property('public') \
+                        if mapper.has_property('public') else None
+    if not isinstance(prop, ColumnProperty):
+        raise sa_exc.InvalidRequestError(
+                    "Publicity of %s is not a column, it can't be updated"
+                    % mapper)
+    query = query.enable_eagerloads(False)
+    if synchronize_session!='fetch':
+        return query.update({prop.key: public},
+                            synchronize_session=synchronize_session)
+    # Query.update() expires updated attributes only, while many-to-one
+    # relationship to partially loaded instance is taken from identity map
+    # without check.
+    session = query.session
+    matched = [mapper.identity_key_from_primary_key(list(row))
+               for row in session.execute(
+                        query.with_entities(*mapper.primary_key).statement)]
+    count = query.update({prop.key: public}, synchronize_session=False)
+    for key in matched:
+        obj = session.identity_map.get(key)
+        if obj is not None:
+            session.expire(obj)
+    return count
+
+
+def _related_criterion(prop, parents):
+    # Criterion of relationship targets for parents matched by query.
+    # Subqueries don't select from target table, since some databases don't
+    # allow it in UPDATE.
+    parent_cols, key_cols, join = _relationship_plan(prop)
+    if len(parent_cols)!=1 or (join is not None and
+                               len(prop.secondary_synchronize_pairs)!=1):
+        raise sa_exc.InvalidRequestError(
+                    "Can't cascade along relationship with composite key %s"
+                    % prop)
+    parent_keys = parents.enable_eagerloads(False)\
+                         .with_entities(parent_cols[0]).statement
+    crit = key_cols[0].in_(parent_keys.correlate(None))
+    if join is not None:
+        target_col, link_col = prop.secondary_synchronize_pairs[0]
+        crit = target_col.in_(select([link_col], crit).correlate(None))
+    return crit
+
+
+def _expire_relationships(session, mappers):
+    for state in list(session.identity_map.all_states()):
+        keys = [prop.key
+                for prop in state.manager.mapper.iterate_properties
+                if isinstance(prop, RelationshipProperty) and
+                   prop.key in state.dict and
+                   any(prop.mapper.isa(mapper) or mapper.isa(prop.mapper)
+                       for mapper in mappers)]
+        if keys:
+            session.expire(state.obj(), keys)
 
 
 if __name__=='__main__':
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+'''
+Denormalized publicity of classes depending on publicity of their parents.
+
+Object is often visible only when its parent (e.g. user of address) is
+visible too. Checking it in queries requires joining parents, instead
+depends() declares such dependency, and effective publicity is stored in
+column of the class: own flag of the object AND publicity criteria of
+parents (which might be dependent themselves, criteria of default audience
+are used). The class provides this column as its "public" criterion, so
+that queries check one (indexed, see indexes.py) column of each table:
+
+    class Address(Base):
+        own_public = Column(Boolean, nullable=False)
+        effective_public = Column(Boolean, nullable=False, default=False)
+        user_id = Column(ForeignKey(User.id))
+        user = relationship(User)
+
+        @hybrid_property
+        def public(self):
+            return self.effective_public
+
+    effective.depends(Address, 'own_public', ['user'])
+    effective.install(Session)
+
+Column is recomputed after each flush of installed sessions for changed
+objects and for children of parents with changed publicity. Changes made
+bypassing flush (Query.update(), other applications) are handled by
+triggers (see trigger_ddl()) or by rebuild of existing data.
+
+Usage:
+
+    python effective.py triggers MODULE [--dialect sqlite]
+    python effective.py rebuild MODULE URL
+
+MODULE is imported to declare dependencies.
+'''
+
+import argparse
+import sys
+from collections import OrderedDict
+from sqlalchemy import event, create_engine, cast, Boolean
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.schema import Column
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_state, get_history
+from sqlalchemy.sql import and_, or_, select, case, literal_column, visitors
+from sqlalchemy.sql.util import ClauseAdapter
+import publicity
+
+
+class Dependency(object):
+
+    def __init__(self, class_, own, parents, column):
+        self.class_ = class_
+        self.own = own
+        self.parents = parents
+        self.column = column
+
+    @property
+    def mapper(self):
+        return class_mapper(self.class_)
+
+    def relationships(self):
+        return [self.mapper.get_property(name) for name in self.parents]
+
+    def watched(self):
+        '''Returns keys of attributes effective publicity depends on.'''
+        mapper = self.mapper
+        keys = [self.own] + list(self.parents)
+        for prop in self.relationships():
+            for fk, pk in prop.local_remote_pairs:
+                keys.append(mapper.get_property_by_column(fk).key)
+        return keys
+
+    def expression(self):
+        '''Returns SQL expression of effective publicity for row of
+        table.'''
+        mapper = self.mapper
+        table = mapper.local_table
+        conditions = [cast(mapper.get_property(self.own).columns[0],
+                           Boolean)]
+        for prop in self.relationships():
+            (fk, pk), = prop.local_remote_pairs
+            crit = publicity.entity_criterion(prop.mapper)
+            if crit is publicity.NOT_FILTERED:
+                continue
+            # Aliased, since parent might be stored in the same table
+            parent = prop.mapper.local_table.alias()
+            adapter = ClauseAdapter(parent)
+            parent_public = select([parent.c[pk.key]],
+                                   and_(parent.c[pk.key]==fk,
+                                        adapter.traverse(crit)))\
+                                .correlate(table).as_scalar()
+            conditions.append(or_(fk==None, parent_public!=None))
+        # Literals, since triggers can't have bound parameters
+        return case([(and_(*conditions), literal_column('1'))],
+                    else_=literal_column('0'))
+
+
+# class -> Dependency
+_dependencies = OrderedDict()
+
+
+def depends(class_, own, parents, column='effective_public'):
+    '''Declares that instances of class_ are public when own attribute is
+    true and targets of many-to-one relationships named in parents are
+    public (or missing). Effective publicity is stored in column attribute
+    named column.'''
+    _dependencies[class_] = Dependency(class_, own, list(parents), column)
+
+
+def _ordered():
+    # Dependencies of parents first
+    result = OrderedDict()
+    def visit(dep):
+        if dep.class_ in result:
+            return
+        result[dep.class_] = None
+        for prop in dep.relationships():
+            if prop.mapper.class_ in _dependencies:
+                visit(_dependencies[prop.mapper.class_])
+        del result[dep.class_]
+        result[dep.class_] = dep
+    for dep in list(_dependencies.values()):
+        visit(dep)
+    return list(result.values())
+
+
+def _check(dep):
+    mapper = dep.mapper
+    if len(mapper.primary_key)!=1:
+        raise sa_exc.InvalidRequestError(
+                    'Effective publicity of %s with composite primary key'
+                    % mapper)
+    for prop in dep.relationships():
+        if len(prop.local_remote_pairs)!=1 or \
+                prop.secondary is not None or \
+                not prop.local_remote_pairs[0][0].table is mapper.local_table:
+            raise sa_exc.InvalidRequestError(
+                    '%s is not a many-to-one relationship by single column'
+                    % prop)
+
+
+def recompute(conn, rows=None, parents=None):
+    '''Recomputes effective publicity. rows maps dependent classes to
+    primary keys of objects to recompute, parents maps classes to primary
+    keys of objects whose publicity has changed, so their children are
+    recomputed. Everything is recomputed when both are None. Returns
+    dictionary mapping dependent classes to recomputed primary keys (None
+    for all rows).'''
+    everything = rows is None and parents is None
+    rows = dict(rows or {})
+    parents = dict(parents or {})
+    recomputed = {}
+    for dep in _ordered():
+        _check(dep)
+        mapper = dep.mapper
+        table = mapper.local_table
+        pk = mapper.primary_key[0]
+        update = table.update()\
+                      .values({mapper.get_property(dep.column).columns[0]:
+                               dep.expression()})
+        if everything:
+            conn.execute(update)
+            recomputed[dep.class_] = None
+            continue
+        conditions = []
+        if rows.get(dep.class_):
+            conditions.append(pk.in_(list(rows[dep.class_])))
+        for prop in dep.relationships():
+            keys = parents.get(prop.mapper.class_)
+            if keys:
+                (fk, parent_pk), = prop.local_remote_pairs
+                conditions.append(fk.in_(list(keys)))
+        if not conditions:
+            continue
+        keys = set(row[0] for row in
+                   conn.execute(select([pk], or_(*conditions))))
+        if not keys:
+            continue
+        conn.execute(update.where(pk.in_(list(keys))))
+        recomputed[dep.class_] = keys
+        # Children of these objects are recomputed too
+        parents[dep.class_] = parents.get(dep.class_, set())|keys
+    return recomputed
+
+
+def rebuild(conn):
+    '''Recomputes effective publicity of all rows.'''
+    recompute(conn)
+
+
+def _publicity_changed(session, obj, mapper):
+    attribute = publicity.policy_attribute(mapper)
+    if attribute is None:
+        return False
+    if mapper.has_property(attribute):
+        return get_history(obj, attribute).has_changes()
+    return session.is_modified(obj)
+
+
+def _after_flush(session, flush_context):
+    if not _dependencies:
+        return
+    rows = {}
+    parents = {}
+    parent_classes = set(prop.mapper.class_ for dep in _dependencies.values()
+                         for prop in dep.relationships())
+    for obj in list(session.new) + list(session.dirty):
+        mapper = instance_state(obj).manager.mapper
+        dep = _dependencies.get(mapper.class_)
+        key = mapper.primary_key_from_instance(obj)[0]
+        if dep is not None:
+            if obj in session.new or \
+                    any(get_history(obj, name).has_changes()
+                        for name in dep.watched()):
+                rows.setdefault(dep.class_, set()).add(key)
+        elif obj not in session.new and \
+                _publicity_changed(session, obj, mapper):
+            for class_ in parent_classes:
+                if mapper.isa(class_mapper(class_)):
+                    parents.setdefault(class_, set()).add(key)
+    if not rows and not parents:
+        return
+    recomputed = recompute(session.connection(), rows, parents)
+    for class_, keys in recomputed.items():
+        dep = _dependencies[class_]
+        mapper = dep.mapper
+        for key in keys:
+            obj = session.identity_map.get(
+                            mapper.identity_key_from_primary_key([key]))
+            if obj is not None:
+                session.expire(obj, [dep.column])
+
+
+def install(target):
+    '''Listen to flushes of target: Session class, sessionmaker or
+    session.'''
+    event.listen(target, 'after_flush', _after_flush)
+
+
+def _column_names(crit, table):
+    return sorted(set(elem.name for elem in visitors.iterate(crit, {})
+                      if isinstance(elem, Column) and elem.table is table))
+
+
+def trigger_ddl(dialect):
+    '''Returns list of statements creating triggers maintaining effective
+    publicity columns for SQLite or PostgreSQL.'''
+    if dialect.name not in ('sqlite', 'postgresql'):
+        raise sa_exc.InvalidRequestError('Triggers for %s' % dialect.name)
+    preparer = dialect.identifier_preparer
+    statements = []
+    def render(stmt):
+        compiled = stmt.compile(dialect=dialect)
+        if compiled.params:
+            raise sa_exc.InvalidRequestError(
+                        "Criterion with parameters can't be used in "
+                        "trigger: %s" % compiled)
+        return str(compiled)
+    def add_trigger(name, events, table, update):
+        if dialect.name=='sqlite':
+            for event_ in events:
+                statements.append(
+                    'CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW BEGIN '
+                    '%s; END' % (preparer.quote('%s_%s' % (
+                                        name, event_.split()[0].lower()),
+                                                None),
+                                 event_, preparer.format_table(table),
+                                 update))
+        else:
+            func = preparer.quote(name, None)
+            statements.append(
+                'CREATE FUNCTION %s() RETURNS trigger AS $$ BEGIN %s; '
+                'RETURN NULL; END $$ LANGUAGE plpgsql' % (func, update))
+            statements.append(
+                'CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW EXECUTE '
+                'PROCEDURE %s()' % (func, ' OR '.join(events),
+                                    preparer.format_table(table), func))
+    for dep in _ordered():
+        _check(dep)
+        mapper = dep.mapper
+        table = mapper.local_table
+        pk = mapper.primary_key[0]
+        update = table.update().values(
+                    {mapper.get_property(dep.column).columns[0]:
+                     dep.expression()})
+        watched = [col.name for name in dep.watched()
+                   for col in getattr(mapper.get_property(name), 'columns',
+                                      [])]
+        row = literal_column('NEW.' + preparer.format_column(pk))
+        add_trigger(
+            '%s_%s' % (table.name, dep.column),
+            ['INSERT', 'UPDATE OF ' + ', '.join(
+                            preparer.quote(name, None) for name in watched)],
+            table, render(update.where(pk==row)))
+        for prop in dep.relationships():
+            (fk, parent_pk), = prop.local_remote_pairs
+            parent_table = prop.mapper.local_table
+            crit = publicity.entity_criterion(prop.mapper)
+            if crit is publicity.NOT_FILTERED:
+                continue
+            columns = _column_names(crit, parent_table)
+            if not columns:
+                continue
+            parent_row = literal_column(
+                            'NEW.' + preparer.format_column(parent_pk))
+            add_trigger(
+                '%s_%s_%s' % (table.name, prop.key, dep.column),
+                ['UPDATE OF ' + ', '.join(preparer.quote(name, None)
+                                          for name in columns)],
+                parent_table, render(update.where(fk==parent_row)))
+    return statements
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    triggers_parser = commands.add_parser('triggers',
+                                          help='print trigger DDL')
+    triggers_parser.add_argument('module')
+    triggers_parser.add_argument('--dialect', default='sqlite')
+    rebuild_parser = commands.add_parser(
+                'rebuild', help='recompute effective publicity of all rows')
+    rebuild_parser.add_argument('module')
+    rebuild_parser.add_argument('url')
+    args = parser.parse_args(argv)
+    # Dependencies are declared in imported effective module, not __main__
+    import effective
+    __import__(args.module)
+
+    if args.command=='triggers':
+        module = __import__('sqlalchemy.dialects.' + args.dialect,
+                            fromlist=['dialect'])
+        for ddl in effective.trigger_ddl(module.dialect()):
+            sys.stdout.write(ddl + ';\n')
+        return
+
+    engine = create_engine(args.url)
+    with engine.begin() as conn:
+        effective.rebuild(conn)
+    engine.dispose()
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+'''
+Partial index advisor for publicity criteria.
+
+Each filtered query has criterion of each participating class in WHERE
+clause. For classes with criterion based on plain column (not expression
+provided by hybrid property) it generates indexes limited to public rows:
+one on primary key (scans, counts and pagination of public rows) and one per
+foreign key (relationship loading and joins). Dialects without partial
+indexes get composite ones with publicity column instead.
+
+Index condition is rendered from the very criterion injected into queries
+(e.g. "CAST(public AS BOOLEAN)"), since databases use partial index only when
+query condition matches the one of index.
+
+Usage:
+
+    python indexes.py ddl [--dialect postgresql]
+    python indexes.py explain [--size 1000] [--with-indexes]
+
+The latter generates benchmark dataset (see bench.py) in SQLite and reports
+EXPLAIN QUERY PLAN of each benchmark query as JSON lines with tables scanned
+entirely.
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import warnings
+from collections import OrderedDict
+
+from sqlalchemy import Column, create_engine
+from sqlalchemy.orm import class_mapper, sessionmaker
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.expression import _Cast, column as unbound_column
+import publicity
+
+# Dialects supporting CREATE INDEX ... WHERE
+PARTIAL_INDEX_DIALECTS = frozenset(['sqlite', 'postgresql'])
+
+
+def _column_criterion(crit):
+    '''Returns column if criterion is a plain boolean column, None
+    otherwise.'''
+    if isinstance(crit, _Cast):
+        crit = crit.clause
+    if isinstance(crit, Column):
+        return crit
+
+
+def public_columns(base):
+    '''Returns ordered dictionary mapping tables of classes from declarative
+    base to (publicity column, criterion) for classes with plain column
+    criterion.'''
+    result = OrderedDict()
+    classes = sorted(base._decl_class_registry.values(),
+                     key=lambda cls: cls.__name__)
+    for cls in classes:
+        try:
+            crit = publicity.entity_criterion(class_mapper(cls))
+        except Exception as exc:
+            warnings.warn('Skipping %s with broken publicity criterion: %r'
+                          % (cls.__name__, exc))
+            continue
+        if crit is publicity.NOT_FILTERED:
+            continue
+        col = _column_criterion(crit)
+        if col is not None and col.table not in result:
+            result[col.table] = (col, crit)
+    return result
+
+
+def _render_condition(crit, dialect):
+    # Index conditions can't refer to columns qualified with table name
+    crit = visitors.replacement_traverse(
+                crit, {},
+                lambda elem: unbound_column(elem.name, type_=elem.type)
+                             if isinstance(elem, Column) else None)
+    return unicode(crit.compile(dialect=dialect))
+
+
+def index_ddl(base, dialect):
+    '''Returns list of CREATE INDEX statements for tables of base.'''
+    preparer = dialect.identifier_preparer
+    partial = dialect.name in PARTIAL_INDEX_DIALECTS
+    statements = []
+    for table, (public_col, crit) in public_columns(base).items():
+        condition = _render_condition(crit, dialect)
+        column_sets = [list(table.primary_key.columns)]
+        for fk in sorted(table.foreign_keys, key=lambda fk: fk.parent.name):
+            if not fk.parent.primary_key:
+                column_sets.append([fk.parent])
+        for cols in column_sets:
+            name = 'ix_%s_%s_public' % (table.name,
+                                        '_'.join(col.name for col in cols))
+            names = [preparer.format_column(col) for col in cols]
+            if partial:
+                ddl = 'CREATE INDEX %s ON %s (%s) WHERE %s' % (
+                            preparer.quote(name, None),
+                            preparer.format_table(table),
+                            ', '.join(names), condition)
+            else:
+                names.insert(0, preparer.format_column(public_col))
+                ddl = 'CREATE INDEX %s ON %s (%s)' % (
+                            preparer.quote(name, None),
+                            preparer.format_table(table), ', '.join(names))
+            statements.append(ddl)
+    return statements
+
+
+def explain(conn, statement):
+    '''Returns list of query plan lines for statement.'''
+    compiled = statement.compile(bind=conn)
+    if conn.dialect.name=='sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    rows = conn.execute(prefix + unicode(compiled), params).fetchall()
+    return [unicode(tuple(row)[-1]) for row in rows]
+
+
+_FULL_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+def full_scans(plan):
+    '''Returns names of tables scanned entirely according to SQLite plan.'''
+    return [match.group(1) for match in map(_FULL_SCAN_RE.match, plan)
+            if match]
+
+
+def explain_benchmark(engine, query_cls, data):
+    '''Yields plans of benchmark scenario queries.'''
+    from bench import SCENARIOS
+    db = sessionmaker(bind=engine, query_cls=query_cls)()
+    try:
+        for name, scenario_func in SCENARIOS.items():
+            query, consume = scenario_func(db, data)
+            if hasattr(query, 'private'):
+                query = query.private()
+            context = query._compile_context()
+            context.statement.use_labels = True
+            with engine.connect() as conn:
+                plan = explain(conn, context.statement)
+            yield OrderedDict([('scenario', name), ('plan', plan),
+                               ('full_scans', full_scans(plan))])
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    from base import Base
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    ddl_parser = commands.add_parser('ddl', help='print index DDL')
+    ddl_parser.add_argument('--dialect', default='sqlite')
+    explain_parser = commands.add_parser(
+                'explain', help='report plans of benchmark queries')
+    explain_parser.add_argument('--size', type=int, default=1000)
+    explain_parser.add_argument('--ratio', type=float, default=0.5)
+    explain_parser.add_argument('--with-indexes', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.command=='ddl':
+        module = __import__('sqlalchemy.dialects.' + args.dialect,
+                            fromlist=['dialect'])
+        for ddl in index_ddl(Base, module.dialect()):
+            sys.stdout.write(ddl + ';\n')
+        return
+
+    import combined, bench
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        engine = create_engine('sqlite:///' + path)
+        bench.populate(engine, args.size, args.ratio)
+        if args.with_indexes:
+            for ddl in index_ddl(Base, engine.dialect):
+                engine.execute(ddl)
+        engine.execute('ANALYZE')
+        data = {'size': args.size, 'ids': range(1, min(args.size, 100)+1)}
+        for result in explain_benchmark(engine, combined.PublicQuery, data):
+            sys.stdout.write(json.dumps(result) + '\n')
+        engine.dispose()
+    finally:
+        os.remove(path)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+import weakref
+from sqlalchemy import event, Table
+from sqlalchemy.orm import Query, Session, with_loader_criteria
+from sqlalchemy.orm.mapper import _all_registries
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.expression import Exists, Select, Alias
+from sqlalchemy.sql.util import ClauseAdapter
+from sqlalchemy.util import LRUCache
+import publicity
+
+
+class PublicQuery(Query):
+
+    '''
+    Filters all queries by publicity condition for each participating mapped
+    class. Attribute "public" of mapped class (if present) should be either
+    boolean column or @hybrid_property providing publicity criterion clause for
+    the class and boolean (convertable to boolean) value for instance of the
+    class.
+
+    Criteria of other audience (see publicity.register_audience()) are
+    applied when session has info = {'audience': name} or query is narrowed
+    with audience(). Lazy loads use audience of session (in addition to one
+    of query which loaded the instance, since options are propagated to
+    them). Polymorphic entities are filtered by criterion of each subclass
+    for rows of its type (see publicity.polymorphic_criterion()), so
+    query(Doc) and query(Event) agree on events.
+
+    Requires SQLAlchemy 1.4 or later. No Query internals are touched: criteria
+    are added to each ORM statement executed by session with this query class
+    (sessionmaker(query_cls=PublicQuery) or PublicSession) as
+    with_loader_criteria() options (see _add_criteria() below), which also
+    apply to eager loads of relationships. Criteria are built once per
+    registry generation and audience, so filtered statements are cached by
+    SQLAlchemy's compiled cache.
+
+    Refresh of expired instance is filtered too, so instance that became
+    private is handled as deleted one: many-to-one relationship to it loads
+    None and access to its attributes raises ObjectDeletedError.
+    '''
+
+    def audience(self, name):
+        '''Applies publicity criteria of named audience instead of the one
+        of session.'''
+        return self.execution_options(audience=name)
+
+    def get(self, ident):
+        # Identity map lookup doesn't use criteria, while instance might
+        # become private in this session.
+        obj = Query.get(self, ident)
+        audience = _audience(self.session, self.get_execution_options())
+        if obj is not None and _instance_public(obj, audience):
+            return obj
+
+
+class PublicSession(Session):
+
+    '''
+    Session using PublicQuery by default. Also usable as sync_session_class
+    of AsyncSession (see async_session.py).
+    '''
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('query_cls', PublicQuery)
+        Session.__init__(self, *args, **kwargs)
+
+    def get(self, entity, ident, **kwargs):
+        # The same as PublicQuery.get() for 2.0 style API
+        obj = Session.get(self, entity, ident, **kwargs)
+        audience = _audience(self, kwargs.get('execution_options') or {})
+        if obj is not None and _instance_public(obj, audience):
+            return obj
+
+
+def _audience(session, execution_options):
+    return execution_options.get('audience', session.info.get('audience'))
+
+
+def _instance_public(obj, audience):
+    public = publicity.instance_publicity(obj, audience)
+    if public is None:
+        # Load of expired criterion column is filtered, it raises
+        # ObjectDeletedError for instance private to audience of session
+        attribute = publicity.policy_attribute(type(obj), audience)
+        public = bool(getattr(obj, attribute))
+    return public
+
+
+def _table_criterion(mapper, crit):
+    # Criterion to put into EXISTS built by any()/has(), which selects from
+    # bare table of target mapper. Criteria referring to other tables (e.g.
+    # to base table of joined inheritance) can't be used there, while tables
+    # of subqueries (subclass criteria of polymorphic one) don't matter.
+    table = mapper.local_table
+    if not isinstance(table, Table) or \
+            set(crit._from_objects)!=set([table]):
+        return None
+    return table, crit
+
+
+def _mapper_criterion(mapper, audience):
+    # Rows of polymorphic hierarchy are filtered by criterion of its base
+    # mapper for all of its entities, which applies criterion of each
+    # subclass to rows of its type.
+    if mapper.polymorphic_on is not None:
+        return publicity.polymorphic_criterion(mapper.base_mapper,
+                                               audience=audience)
+    return publicity.entity_criterion(mapper, audience)
+
+
+def _build_criteria(audience):
+    options = []
+    table_criteria = {}
+    mappers = [mapper for registry in _all_registries()
+               for mapper in registry.mappers]
+    for mapper in mappers:
+        if not publicity.is_filtered(mapper, audience):
+            continue
+        try:
+            crit = _mapper_criterion(mapper, audience)
+        except Exception:
+            # Raised when the class is actually queried, see
+            # _add_criteria()
+            continue
+        if mapper is mapper.base_mapper or mapper.polymorphic_on is None:
+            # Option for class applies to its subclasses too
+            options.append(with_loader_criteria(
+                        mapper.class_, crit, include_aliases=True))
+        if mapper is not mapper.base_mapper:
+            crit = publicity.entity_criterion(mapper, audience)
+        item = _table_criterion(mapper, crit)
+        if item is not None:
+            table_criteria.setdefault(*item)
+    return tuple(options), table_criteria
+
+
+# Options and table criteria are built once per registry generation and
+# audience
+_compiled = (None, {})
+
+def _criteria(audience):
+    global _compiled
+    if _compiled[0]!=publicity.generation():
+        _compiled = publicity.generation(), {}
+    by_audience = _compiled[1]
+    if audience not in by_audience:
+        by_audience[audience] = _build_criteria(audience)
+    return by_audience[audience]
+
+
+def _filter_exists(statement, table_criteria):
+    # Loader criteria are not applied to Core subqueries: relationship
+    # comparators any() and has() select from bare (not annotated) tables.
+    # Returns None when there is nothing to filter.
+    replaced = []
+    def replace(elem):
+        if not isinstance(elem, Exists):
+            return None
+        select = elem.element
+        while hasattr(select, 'element'):
+            select = select.element
+        criteria = []
+        for from_ in select.get_final_froms():
+            if isinstance(from_, Alias):
+                # Target of any() is aliased class
+                crit = table_criteria.get(from_.element)
+                if crit is not None:
+                    criteria.append(ClauseAdapter(from_).traverse(crit))
+            elif not from_._annotations and from_ in table_criteria:
+                criteria.append(table_criteria[from_])
+        if criteria:
+            replaced.append(elem)
+            # Nested EXISTS are not traversed after replacement
+            select = visitors.replacement_traverse(select, {}, replace)
+            return select.where(*criteria).exists()
+    statement = visitors.replacement_traverse(statement, {}, replace)
+    if replaced:
+        return statement
+
+
+# (registry generation, audience, cache key structure) -> (cache key,
+# statement with filtered EXISTS or None)
+_filtered = LRUCache(500)
+
+def _filter_exists_cached(statement, audience, table_criteria):
+    # Result of traversal depends on statement structure only, so it's
+    # cached by statement cache key and gets parameters of each statement.
+    # The key is memoized in statement and used by compiled cache, so
+    # statements without EXISTS to filter are not traversed twice.
+    cache_key = statement._generate_cache_key()
+    if cache_key is None:
+        return _filter_exists(statement, table_criteria) or statement
+    key = publicity.generation(), audience, cache_key.key
+    entry = _filtered.get(key)
+    if entry is None:
+        entry = _filtered[key] = \
+                cache_key, _filter_exists(statement, table_criteria)
+    original_key, filtered = entry
+    if filtered is None:
+        return statement
+    return cache_key._apply_params_to_element(original_key, filtered)
+
+
+# Session -> whether it uses PublicQuery. Query class is passed to Session
+# (or sessionmaker) constructor and never changes.
+_public_sessions = weakref.WeakKeyDictionary()
+
+def _is_public(session):
+    public = _public_sessions.get(session)
+    if public is None:
+        public = _public_sessions[session] = \
+                 isinstance(session.query(), PublicQuery)
+    return public
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _add_criteria(execute_state):
+    if not execute_state.is_select or \
+            not _is_public(execute_state.session):
+        return
+    audience = _audience(execute_state.session,
+                         execute_state.execution_options)
+    options, table_criteria = _criteria(audience)
+    statement = execute_state.statement
+    if not isinstance(statement, Select):
+        # Query.from_statement() and load of subclass table columns
+        execute_state.statement = statement.options(*options)
+        return
+    for mapper in execute_state.all_mappers:
+        # Raises for broken criterion instead of making data public
+        _mapper_criterion(mapper, audience)
+    if execute_state.is_column_load:
+        # Loader criteria are not applied to refresh of expired or deferred
+        # attributes of instance we already have.
+        mapper = execute_state.bind_mapper
+        if publicity.is_filtered(mapper, audience):
+            statement = statement.where(
+                        publicity.entity_criterion(mapper, audience))
+    else:
+        statement = statement.options(*options)
+    if table_criteria:
+        statement = _filter_exists_cached(statement, audience,
+                                          table_criteria)
+    execute_state.statement = statement
+
+
+if __name__=='__main__':
+    import unittest
+    from base import make_suite, PolymorphicTest
+    suite = make_suite(PublicQuery)
+    # Subclass criteria are always applied, there is no polymorphic_criteria
+    # switch the feature is detected by
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+                                                            PolymorphicTest))
+    unittest.TextTestRunner().run(suite)
@@ -0,0 +1,87 @@
+'''
+Batch loading of relationships through session's (public) query class.
+
+Loading collections of many parent objects lazily costs a query per parent.
+selectin_load() loads a relationship for all given parents with one query per
+chunk of parent keys ("WHERE fk IN (...)"), so with PublicQuery session each
+such query gets criterion of the target class injected as usual.
+'''
+
+from sqlalchemy import and_, or_, exc as sa_exc
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOONE, MANYTOMANY
+
+
+def _in_criterion(columns, keys):
+    if len(columns)==1:
+        return columns[0].in_([key[0] for key in keys])
+    # Tuple IN is not supported by all backends
+    return or_(*[and_(*[col==value for col, value in zip(columns, key)])
+                 for key in keys])
+
+
+def _relationship_plan(prop):
+    '''Returns parent columns identifying parent object, columns of query
+    matching them, and (table, onclause) to join or None.'''
+    if prop.direction is ONETOMANY:
+        return ([l for l, r in prop.synchronize_pairs],
+                [r for l, r in prop.synchronize_pairs], None)
+    elif prop.direction is MANYTOONE:
+        return ([r for l, r in prop.synchronize_pairs],
+                [l for l, r in prop.synchronize_pairs], None)
+    elif prop.direction is MANYTOMANY:
+        onclause = and_(*[target_col==link_col for target_col, link_col
+                          in prop.secondary_synchronize_pairs])
+        return ([l for l, r in prop.synchronize_pairs],
+                [r for l, r in prop.synchronize_pairs],
+                (prop.secondary, onclause))
+    raise sa_exc.InvalidRequestError(
+                "Can't batch load relationship %s" % prop)
+
+
+def selectin_load(instances, attribute, chunk_size=400):
+    '''
+    Loads relationship attribute (e.g. User.addresses) of all instances in
+    batches. Instances having the attribute already loaded are left intact.
+    '''
+    prop = attribute.property
+    key = prop.key
+    parent_mapper = prop.parent
+    parent_cols, key_cols, join = _relationship_plan(prop)
+
+    by_key = {}
+    for instance in instances:
+        state = instance_state(instance)
+        if key in state.dict:
+            continue
+        ident = tuple(
+                parent_mapper._get_state_attr_by_column(state, state.dict,
+                                                        col)
+                for col in parent_cols)
+        by_key.setdefault(ident, []).append(instance)
+    if not by_key:
+        return
+
+    session = object_session(instances[0])
+    found = dict((ident, []) for ident in by_key)
+    idents = [ident for ident in by_key if None not in ident]
+    for start in range(0, len(idents), chunk_size):
+        chunk = idents[start:start+chunk_size]
+        query = session.query(prop.mapper, *key_cols)
+        if join is not None:
+            query = query.join(join)
+        query = query.filter(_in_criterion(key_cols, chunk))
+        if prop.order_by:
+            query = query.order_by(*prop.order_by)
+        for row in query:
+            found[tuple(row[1:])].append(row[0])
+
+    for ident, parents in by_key.items():
+        targets = found[ident]
+        for instance in parents:
+            if prop.uselist:
+                value = list(targets)
+            else:
+                value = targets[0] if targets else None
+            set_committed_value(instance, key, value)
@@ -0,0 +1,52 @@
+'''
+Metrics sinks for instrumented PublicQuery.
+
+Sink is any callable accepting metric name, value and tuple of names of mapped
+classes the value relates to. Set it as metrics_sink attribute of
+combined.PublicQuery (or its subclass) to enable instrumentation. Reported
+metrics:
+
+    criteria_time       seconds spent building criteria in private()
+    entities_filtered   number of criteria injected into query
+    bypass.limit        query not filtered in private() since LIMIT,
+    bypass.offset       OFFSET or statement was already set (value is 1)
+    bypass.statement
+    compile_time        seconds spent compiling SQL statement
+    rows                number of rows returned
+'''
+
+import threading
+from collections import defaultdict
+
+
+class CollectingSink(object):
+
+    '''
+    Accumulates count, total and maximum of each metric per mapped class in
+    memory. Values for queries involving several classes are accounted for
+    each of them.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # (metric, class name) -> [count, total, max]
+            self.stats = defaultdict(lambda: [0, 0, None])
+
+    def __call__(self, metric, value, classes):
+        with self._lock:
+            for class_name in classes or (None,):
+                stat = self.stats[metric, class_name]
+                stat[0] += 1
+                stat[1] += value
+                if stat[2] is None or value>stat[2]:
+                    stat[2] = value
+
+    def count(self, metric, class_name=None):
+        return self.stats.get((metric, class_name), [0])[0]
+
+    def total(self, metric, class_name=None):
+        return self.stats.get((metric, class_name), [0, 0])[1]
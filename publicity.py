@@ -0,0 +1,336 @@
+'''
+Registry of publicity criteria for mapped classes.
+
+Criterion for each mapped class is resolved once, when mappers are
+configured, instead of walking dir() of the class and building the clause for
+each entity of each query. Registry is keyed by mapper: entries of mappers
+disposed by clear_mappers() are pruned on next configuration and re-created
+ones are resolved again on their own configuration.
+
+Several audiences (visibility policies) can be registered with
+register_audience(), each with its own criterion attribute. Criteria are
+resolved and cached per (mapper, audience), so selecting audience for query
+costs nothing.
+'''
+
+import weakref
+from sqlalchemy import event, cast, Boolean
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.orm import Mapper, configure_mappers
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.util import _class_to_mapper
+from sqlalchemy.sql import ClauseElement, visitors
+from sqlalchemy.sql.util import _deep_deannotate
+from sqlalchemy.sql.expression import and_, or_, select
+from sqlalchemy.schema import Column
+try:
+    from sqlalchemy.orm.mapper import _all_registries
+except ImportError:
+    # SQLAlchemy before 1.4 has single registry of mappers
+    from sqlalchemy.orm.mapper import _mapper_registry
+    def _live_mappers():
+        return _mapper_registry
+else:
+    def _live_mappers():
+        return set(mapper for registry in _all_registries()
+                   for mapper in registry.mappers)
+
+
+class _NotFiltered(object):
+
+    def __repr__(self):
+        return 'NOT_FILTERED'
+
+NOT_FILTERED = _NotFiltered()
+
+
+class _Failure(object):
+    '''Error raised while resolving criterion. It's stored to be raised on
+    each use of the class, since swallowing it would make private data
+    public.'''
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+# mapper -> {audience -> (attribute, criterion clause, NOT_FILTERED or
+# _Failure)}
+_registry = weakref.WeakKeyDictionary()
+# audience -> name of attribute providing its criterion, None is the default
+# audience
+_audiences = {None: 'public'}
+# Mappers (re)configured since last after_configured event
+_pending = weakref.WeakKeyDictionary()
+# Incremented each time registry changes, so that things built from resolved
+# criteria know when to drop them
+_generation = 0
+
+
+def _policy_attribute(class_, audience):
+    if audience not in _audiences:
+        raise ValueError('Unknown audience %r' % (audience,))
+    attribute = _audiences[audience]
+    if attribute is None:
+        return None
+    # Don't use getattr/hasattr to check attribute existence, since this
+    # might misinterpret a bug (AttributeError raised by some code in
+    # property implementation) as missing attribute and cause all private
+    # data going to public.
+    names = dir(class_)
+    if attribute not in names:
+        # Classes without their own policy for the audience use the default
+        # one
+        attribute = _audiences[None]
+        if attribute not in names:
+            return None
+    return attribute
+
+
+def _resolve(class_, attribute):
+    if attribute is None:
+        return NOT_FILTERED
+    crit = getattr(class_, attribute)
+    if crit is None:
+        return NOT_FILTERED
+    if not isinstance(crit, ClauseElement):
+        # This simplest safe way to make bare boolean column accepted as
+        # expression.
+        crit = cast(crit, Boolean)
+    return crit
+
+
+def _resolve_mapper(mapper, audience=None):
+    attribute = _policy_attribute(mapper.class_, audience)
+    try:
+        entry = _resolve(mapper.class_, attribute)
+    except Exception as exc:
+        entry = _Failure(exc)
+    _registry.setdefault(mapper, {})[audience] = attribute, entry
+    _pending.pop(mapper, None)
+    return attribute, entry
+
+
+@event.listens_for(Mapper, 'mapper_configured')
+def _mapper_configured(mapper, class_):
+    # Other mappers might be not configured yet at this point, so we only
+    # invalidate here and resolve when all of them are ready.
+    _registry.pop(mapper, None)
+    _pending[mapper] = True
+
+
+def _prune():
+    # Criteria (annotated with their mappers) and failures (via traceback)
+    # refer to mappers, so weak keys alone never let entries go.
+    live = _live_mappers()
+    disposed = [mapper for mapper in list(_registry.keys())
+                if mapper not in live]
+    for mapper in disposed:
+        del _registry[mapper]
+    return bool(disposed)
+
+
+@event.listens_for(Mapper, 'after_configured')
+def _after_configured():
+    global _generation
+    if _prune() or _pending:
+        _generation += 1
+    for mapper in list(_pending.keys()):
+        _resolve_mapper(mapper)
+
+
+def generation():
+    '''Returns current generation of registry.'''
+    return _generation
+
+
+def register_audience(name, attribute):
+    '''Registers audience (e.g. "anonymous" or "staff") filtered by criterion
+    provided by attribute of mapped classes the same way as by "public" for
+    default audience. Classes without the attribute are filtered by "public",
+    None attribute makes everything visible to the audience.'''
+    _audiences[name] = attribute
+    invalidate()
+
+
+def audiences():
+    '''Returns names of registered audiences, None for default one.'''
+    return list(_audiences)
+
+
+def invalidate(mapper=None):
+    '''Forget resolved criterion for mapper (all mappers by default), it will
+    be resolved again on next use.'''
+    global _generation
+    _generation += 1
+    if mapper is None:
+        _registry.clear()
+    else:
+        _registry.pop(mapper, None)
+
+
+def _entry(entity, audience=None):
+    if hasattr(entity, 'parententity'):
+        entity = entity.parententity
+    mapper = _class_to_mapper(entity)
+    entries = _registry.get(mapper)
+    if entries is None or mapper in _pending:
+        configure_mappers()
+        entries = _registry.get(mapper)
+    if entries is None or audience not in entries:
+        return _resolve_mapper(mapper, audience)
+    return entries[audience]
+
+
+def entity_criterion(entity, audience=None):
+    '''Returns publicity criterion clause of audience for mapped class,
+    mapper or attribute of mapped class. NOT_FILTERED is returned for classes
+    without publicity criterion.'''
+    entry = _entry(entity, audience)[1]
+    if isinstance(entry, _Failure):
+        raise entry.exc
+    return entry
+
+
+def is_filtered(entity, audience=None):
+    '''Returns False for classes without publicity criterion. Classes with
+    broken criterion are considered filtered.'''
+    return _entry(entity, audience)[1] is not NOT_FILTERED
+
+
+def policy_attribute(entity, audience=None):
+    '''Returns name of attribute providing publicity criterion of audience
+    for mapped class, or None if there is no such attribute.'''
+    return _entry(entity, audience)[0]
+
+
+def policy_attributes(entity):
+    '''Returns set of attribute names providing criteria of all audiences
+    filtering mapped class.'''
+    names = set()
+    for audience in audiences():
+        attribute, entry = _entry(entity, audience)
+        if entry is not NOT_FILTERED:
+            names.add(attribute)
+    return names
+
+
+def instance_publicity(obj, audience=None):
+    '''Returns publicity of instance for audience judging by its loaded
+    state: True or False, or None when criterion column is not loaded
+    (expired or deferred) and should be checked in database.'''
+    state = instance_state(obj)
+    mapper = state.manager.mapper
+    attribute, entry = _entry(mapper, audience)
+    if entry is NOT_FILTERED:
+        return True
+    if isinstance(entry, _Failure):
+        raise entry.exc
+    if mapper.has_property(attribute) and attribute in state.unloaded:
+        return None
+    return bool(getattr(obj, attribute))
+
+
+def _same_criterion(crit, other):
+    if crit is other:
+        return True
+    if crit is NOT_FILTERED or other is NOT_FILTERED:
+        return False
+    # Registry has separate clause for each class sharing a column, with
+    # columns annotated by class attributes. Cast doesn't implement compare().
+    if crit.__visit_name__==other.__visit_name__=='cast':
+        crit, other = crit.clause, other.clause
+    return _deep_deannotate(crit).compare(_deep_deannotate(other))
+
+
+def _criterion_tables(crit):
+    return set(elem.table for elem in visitors.iterate(crit, {})
+               if isinstance(elem, Column))
+
+
+def _build_polymorphic_criterion(mapper, loaded, audience):
+    base_crit = entity_criterion(mapper, audience)
+    if mapper.polymorphic_on is None:
+        return base_crit
+    # [criterion, [mappers]] for mappers having rows of their own
+    groups = []
+    # Descendants are kept in a set, while statement should be the same in
+    # each process.
+    submappers = sorted(mapper.self_and_descendants,
+                        key=lambda m: (m is not mapper, m.class_.__name__))
+    for submapper in submappers:
+        if submapper.polymorphic_identity is None:
+            continue
+        crit = entity_criterion(submapper, audience)
+        for group in groups:
+            if _same_criterion(group[0], crit):
+                group[1].append(submapper)
+                break
+        else:
+            groups.append([crit, [submapper]])
+    available = set(mapper.tables)
+    for submapper in loaded:
+        available.update(submapper.tables)
+    # Rows of mappers sharing criterion of base mapper and rows without
+    # registered identity (loaded as base mapper) are selected by excluding
+    # identities of the rest.
+    groups = [group for group in groups
+              if not _same_criterion(group[0], base_crit)]
+    if not groups:
+        return base_crit
+    clauses = []
+    for crit, submappers in groups:
+        identities = [m.polymorphic_identity for m in submappers]
+        of_type = mapper.polymorphic_on.in_(identities)
+        if crit is NOT_FILTERED:
+            clauses.append(of_type)
+        elif _criterion_tables(crit)<=available:
+            clauses.append(and_(of_type, crit))
+        else:
+            # Columns of subclass tables are not loaded, so we check rows
+            # with subquery instead of joining them.
+            if len(mapper.primary_key)!=1:
+                raise sa_exc.InvalidRequestError(
+                            'Subclass criteria of %s with composite primary '
+                            'key require with_polymorphic()' % mapper)
+            for submapper in submappers:
+                table = submapper.local_table
+                if _criterion_tables(crit)<=set([table]) and \
+                        len(table.primary_key)==1:
+                    public_ids = select(list(table.primary_key), crit)
+                else:
+                    public_ids = select([submapper.primary_key[0]], crit,
+                                        from_obj=[submapper.mapped_table])
+                clauses.append(and_(
+                    mapper.polymorphic_on==submapper.polymorphic_identity,
+                    mapper.primary_key[0].in_(public_ids.correlate(None))))
+    identities = [m.polymorphic_identity
+                  for crit, submappers in groups for m in submappers]
+    of_base_type = or_(mapper.polymorphic_on==None,
+                       ~mapper.polymorphic_on.in_(identities))
+    if base_crit is NOT_FILTERED:
+        clauses.append(of_base_type)
+    else:
+        clauses.append(and_(of_base_type, base_crit))
+    return or_(*clauses)
+
+
+# mapper -> {(audience, frozenset of loaded mappers) -> criterion}
+_polymorphic = weakref.WeakKeyDictionary()
+_polymorphic_generation = None
+
+def polymorphic_criterion(mapper, loaded=(), audience=None):
+    '''Returns publicity criterion for rows of polymorphic mapper, which
+    applies criterion of each subclass to rows of its type. Columns of
+    subclasses in loaded (mappers loaded with with_polymorphic()) are used
+    directly, rows of the rest are checked with subquery.'''
+    global _polymorphic_generation
+    entity_criterion(mapper, audience)
+    if _polymorphic_generation!=_generation:
+        _polymorphic.clear()
+        _polymorphic_generation = _generation
+    by_loaded = _polymorphic.setdefault(mapper, {})
+    key = audience, frozenset(loaded)
+    if key not in by_loaded:
+        by_loaded[key] = _build_polymorphic_criterion(mapper, key[1],
+                                                      audience)
+    return by_loaded[key]
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+'''
+Statement count and query shape regression check for PublicQuery
+implementations.
+
+Runs tests from base.py with given strategy and records statements emitted
+by each test (after fixture is created): normalized SQL and number of
+references to publicity criteria columns in it (outside of selected columns
+list). The result is compared to snapshot stored in query_shapes/ directory,
+so that extra queries (N+1) or duplicated criteria are reported even when
+tests pass. Snapshots depend on SQLAlchemy version and dialect.
+
+Usage:
+
+    python query_shapes.py combined          # compare, exit status 1 on
+                                             # difference
+    python query_shapes.py combined --update # store new snapshot
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+import unittest
+from sqlalchemy import event
+from sqlalchemy.schema import Column
+from sqlalchemy.sql import visitors
+import publicity
+import base
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'query_shapes')
+
+
+def normalize(statement):
+    '''Returns statement with whitespace collapsed.'''
+    return ' '.join(statement.split())
+
+
+def _criteria_columns():
+    # Names of columns participating in publicity criteria of all mapped
+    # classes from base.py.
+    names = set()
+    for class_ in base.Base._decl_class_registry.values():
+        if not hasattr(class_, '__mapper__'):
+            continue
+        try:
+            crit = publicity.entity_criterion(class_)
+        except Exception:
+            continue
+        if crit is not publicity.NOT_FILTERED:
+            names.update(elem.name for elem in visitors.iterate(crit, {})
+                         if isinstance(elem, Column))
+    return names
+
+
+def count_criteria(statement, columns):
+    '''Returns number of qualified references to columns in statement
+    after its first FROM.'''
+    pos = statement.find(' FROM ')
+    if pos<0:
+        return 0
+    pattern = r'[\w"]+\."?(?:%s)\b' % '|'.join(map(re.escape,
+                                                    sorted(columns)))
+    return len(re.findall(pattern, statement[pos:]))
+
+
+class Recorder(object):
+
+    '''Collects [(normalized SQL, number of criteria references)] per test.
+    Set it as STATEMENT_RECORDER of base.DataTestCase.'''
+
+    def __init__(self):
+        self.shapes = {}
+        self._columns = None
+
+    def __call__(self, engine, test_id):
+        if self._columns is None:
+            self._columns = _criteria_columns()
+        statements = self.shapes[test_id] = []
+        @event.listens_for(engine, 'before_cursor_execute')
+        def record(conn, cursor, statement, parameters, context,
+                   executemany):
+            statement = normalize(statement)
+            statements.append(
+                    [statement, count_criteria(statement, self._columns)])
+
+
+# Run of LEFT OUTER JOINs by primary key, as with_polymorphic() adds
+_POLYMORPHIC_JOINS = re.compile(
+                r'(?: LEFT OUTER JOIN ([\w"]+) ON [\w."]+ = [\w."]+)+')
+
+
+def _split_columns(columns):
+    # Splits select list by commas outside of parentheses
+    items, depth, start = [], 0, 0
+    for pos, char in enumerate(columns):
+        if char=='(':
+            depth += 1
+        elif char==')':
+            depth -= 1
+        elif char==',' and depth==0:
+            items.append(columns[start:pos].strip())
+            start = pos+1
+    items.append(columns[start:].strip())
+    return items
+
+
+def canonical(statement):
+    '''Returns statement with joins added by with_polymorphic() and
+    columns of joined tables sorted by table name. SQLAlchemy orders
+    sibling subclass mappers arbitrarily, everything else is kept in
+    order.'''
+    for match in list(_POLYMORPHIC_JOINS.finditer(statement)):
+        joins = re.findall(r' LEFT OUTER JOIN [\w"]+ ON [^ ]+ = [^ ]+',
+                           match.group(0))
+        tables = sorted(re.findall(r'JOIN ([\w"]+)', match.group(0)))
+        statement = statement[:match.start()] + ''.join(sorted(joins)) + \
+                    statement[match.end():]
+        select = statement.rfind('SELECT ', 0, match.start())
+        from_ = statement.find(' FROM ', select)
+        if select<0 or from_<0:
+            continue
+        prefix = 'SELECT DISTINCT ' \
+                 if statement.startswith('SELECT DISTINCT ', select) \
+                 else 'SELECT '
+        items = _split_columns(statement[select+len(prefix):from_])
+        def table_of(item):
+            for table in tables:
+                if item.startswith(table + '.'):
+                    return table
+        positions = [i for i, item in enumerate(items) if table_of(item)]
+        # Stable sort keeps order of columns of the same table
+        joined = sorted([items[i] for i in positions], key=table_of)
+        for i, item in zip(positions, joined):
+            items[i] = item
+        statement = statement[:select] + prefix + ', '.join(items) + \
+                    statement[from_:]
+    return statement
+
+
+def compare(expected, actual):
+    '''Returns list of human readable differences between snapshots.'''
+    problems = []
+    for test_id in sorted(set(expected)|set(actual)):
+        if test_id not in actual:
+            problems.append('%s: not run' % test_id)
+            continue
+        if test_id not in expected:
+            problems.append('%s: not in snapshot' % test_id)
+            continue
+        old, new = expected[test_id], actual[test_id]
+        if len(new)!=len(old):
+            problems.append('%s: %d statements, was %d' % (
+                                            test_id, len(new), len(old)))
+        for i, ((old_sql, old_refs), (new_sql, new_refs)) in \
+                enumerate(zip(old, new)):
+            if new_refs!=old_refs:
+                problems.append(
+                    '%s: statement %d references criteria %d times, '
+                    'was %d\n    %s' % (test_id, i+1, new_refs, old_refs,
+                                        new_sql))
+            elif canonical(new_sql)!=canonical(old_sql):
+                problems.append('%s: statement %d changed\n    was: %s\n'
+                                '    now: %s' % (test_id, i+1, old_sql,
+                                                 new_sql))
+    return problems
+
+
+def record(query_cls):
+    '''Runs tests with query_cls and returns recorded shapes.'''
+    recorder = Recorder()
+    base.DataTestCase.STATEMENT_RECORDER = recorder
+    try:
+        suite = base.make_suite(query_cls)
+        # Failures are reported by strategy's own test run
+        unittest.TextTestRunner(stream=open(os.devnull, 'w')).run(suite)
+    finally:
+        base.DataTestCase.STATEMENT_RECORDER = None
+    return recorder.shapes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                description=__doc__.split('\n\n')[1],
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('strategy',
+                        help='module providing PublicQuery, e.g. combined')
+    parser.add_argument('--update', action='store_true',
+                        help='store snapshot instead of comparing')
+    args = parser.parse_args(argv)
+    query_cls = __import__(args.strategy).PublicQuery
+    shapes = record(query_cls)
+    path = os.path.join(SNAPSHOT_DIR, args.strategy + '.json')
+    if args.update:
+        if not os.path.isdir(SNAPSHOT_DIR):
+            os.makedirs(SNAPSHOT_DIR)
+        with open(path, 'w') as fp:
+            json.dump(shapes, fp, indent=1, sort_keys=True)
+        return 0
+    with open(path) as fp:
+        expected = json.load(fp)
+    problems = compare(expected, shapes)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -1,8 +1,9 @@
 #!/usr/bin/python
 
-from sqlalchemy.orm.query import Query
+from sqlalchemy.orm.query import Query, _generative
 from sqlalchemy.sql import ClauseElement
 from sqlalchemy import cast, Boolean
+from publicity import policy_attribute
 
 
 class PublicQuery(Query):
@@ -12,15 +13,31 @@ class PublicQuery(Query):
     class. Attribute "public" of mapped class (if present) should be either
     boolean column or @hybrid_property providing publicity criterion clause for
     the class and boolean (convertable to boolean) value for instance of the
-    class.
+    class. Other audiences (see publicity.register_audience()) are selected
+    with session.info['audience'] or audience().
 
     A bit modified version of recipe from
     http://www.sqlalchemy.org/trac/wiki/UsageRecipes/PreFilteredQuery
     '''
 
+    # See combined.PublicQuery.reads_public
+    reads_public = True
+
+    def __init__(self, entities, session=None):
+        Query.__init__(self, entities, session)
+        info = getattr(session, 'info', None) or {}
+        self._audience = info.get('audience')
+
+    @_generative()
+    def audience(self, name):
+        self._audience = name
+
     def get(self, ident):
         obj = Query.get(self, ident)
-        if obj is not None and getattr(obj, 'public', True):
+        if obj is None:
+            return None
+        attribute = policy_attribute(obj.__class__, self._audience)
+        if attribute is None or getattr(obj, attribute, True):
             return obj
         # Other option:
         # override get() so that the flag is always checked in the 
@@ -38,9 +55,10 @@ class PublicQuery(Query):
 
     def private(self):
         mzero = self._mapper_zero()
-        if mzero is not None and \
-                getattr(mzero.class_, 'public', None) is not None:
-            crit = mzero.class_.public
+        attribute = mzero is not None and \
+                    policy_attribute(mzero, self._audience)
+        if attribute and getattr(mzero.class_, attribute, None) is not None:
+            crit = getattr(mzero.class_, attribute)
             if not isinstance(crit, ClauseElement):
                 # This simplest safe way to make bare boolean column accepted
                 # as expression.
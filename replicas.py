@@ -0,0 +1,158 @@
+#!/usr/bin/python
+'''
+Routing of public reads to read replicas.
+
+ReplicaSession with publicity filtering query class (recipe, combined or
+stm_old PublicQuery, or any other with true reads_public attribute) sends
+SELECT statements to one of replica engines, while flushes, bulk updates and
+deletes, SELECT ... FOR UPDATE and everything else go to the primary bind.
+Sessions with standard Query class use primary only, since they read private
+data too.
+
+Replicas lag behind primary, so after the first write session sticks to
+primary until it's closed and reads its own changes. Changes made by other
+sessions might be seen later. Note that Query.update() with 'fetch'
+synchronization (and set_public() of combined.PublicQuery) selects matched
+rows before the first write, i.e. from replica.
+
+    Session = sessionmaker(class_=ReplicaSession, bind=primary,
+                           replicas=[replica1, replica2],
+                           query_cls=PublicQuery)
+'''
+
+import random
+from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.expression import Select, CompoundSelect, UpdateBase
+
+
+class ReplicaSession(Session):
+
+    def __init__(self, replicas=(), **kwargs):
+        Session.__init__(self, **kwargs)
+        self.replicas = list(replicas)
+        self.stick_to_primary = False
+
+    def _reads_public(self):
+        return getattr(self._query_cls, 'reads_public', False)
+
+    def choose_replica(self):
+        '''Returns engine to read from, random replica by default.'''
+        return random.choice(self.replicas)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.stick_to_primary = True
+        elif self.replicas and not self.stick_to_primary and \
+                isinstance(clause, (Select, CompoundSelect)) and \
+                not getattr(clause, 'for_update', False) and \
+                self._reads_public():
+            return self.choose_replica()
+        return Session.get_bind(self, mapper, clause, **kwargs)
+
+    def close(self):
+        Session.close(self)
+        self.stick_to_primary = False
+
+
+if __name__=='__main__':
+    import os
+    import shutil
+    import tempfile
+    import unittest
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from combined import PublicQuery
+    import stm_old
+    import base
+    from base import User, Address
+
+    class ReplicaTest(base.DataTestCase):
+
+        # Primary and replicas are files, replicas are copied from primary
+        # after fixture is created. Rows changed with dba session afterwards
+        # show replica lag.
+
+        QUERY_CLS = PublicQuery
+
+        def create_engine(self):
+            self.dir = tempfile.mkdtemp()
+            return self._file_engine('primary')
+
+        def _file_engine(self, name):
+            engine = create_engine('sqlite:///' +
+                                   os.path.join(self.dir, name + '.sqlite'))
+            engine.statements = []
+            @event.listens_for(engine, 'before_cursor_execute')
+            def record(conn, cursor, statement, *args):
+                engine.statements.append(statement)
+            return engine
+
+        def create_public_session(self, engine):
+            self.replicas = []
+            for i in range(2):
+                name = 'replica%d' % i
+                shutil.copy(os.path.join(self.dir, 'primary.sqlite'),
+                            os.path.join(self.dir, name + '.sqlite'))
+                self.replicas.append(self._file_engine(name))
+            self.Session = sessionmaker(class_=ReplicaSession, bind=engine,
+                                        replicas=self.replicas,
+                                        query_cls=self.QUERY_CLS)
+            # Make u6 private on primary only
+            self.dba.query(User).filter_by(name='u6')\
+                    .update({'public': False}, synchronize_session=False)
+            self.dba.commit()
+            del engine.statements[:]
+            return self.Session()
+
+        def tearDown(self):
+            base.DataTestCase.tearDown(self)
+            for engine in [self.engine] + self.replicas:
+                engine.dispose()
+            shutil.rmtree(self.dir)
+
+        def replica_statements(self):
+            return sum(len(engine.statements) for engine in self.replicas)
+
+        def test_read_replica(self):
+            names = [u.name for u in self.dbp.query(User)]
+            self.assertEqual(names, ['u1', 'u2', 'u5', 'u6'])
+            self.assertEqual(self.dbp.query(Address).count(), 5)
+            user = self.dbp.query(User).filter_by(name='u1').one()
+            self.assertEqual(len(user.addresses), 2)
+            self.assertEqual(self.engine.statements, [])
+            self.assertEqual(self.replica_statements(), 4)
+
+        def test_stick_to_primary(self):
+            user = self.dbp.query(User).filter_by(name='u1').one()
+            user.name = 'u1x'
+            # Autoflush before query
+            names = [u.name for u in self.dbp.query(User)]
+            self.assertEqual(names, ['u1x', 'u2', 'u5'])
+            self.dbp.commit()
+            self.assertEqual(self.dbp.query(User).count(), 3)
+            self.dbp.close()
+            self.assertEqual(self.dbp.query(User).count(), 4)
+
+        def test_bulk_update(self):
+            self.dbp.query(User).filter_by(name='u1')\
+                    .update({'name': 'u1x'}, synchronize_session=False)
+            self.assertTrue(self.dbp.stick_to_primary)
+            self.assertEqual(self.dbp.query(User.name).filter_by(name='u1x')
+                                     .count(), 1)
+
+        def test_for_update(self):
+            self.dbp.query(User).with_lockmode('update').all()
+            self.assertEqual(self.replica_statements(), 0)
+
+        def test_unfiltered_session(self):
+            db = sessionmaker(class_=ReplicaSession, bind=self.engine,
+                              replicas=self.replicas)()
+            self.assertEqual(db.query(User).count(), 6)
+            self.assertEqual(self.replica_statements(), 0)
+            db.close()
+
+    class StmOldReplicaTest(ReplicaTest):
+
+        QUERY_CLS = stm_old.PublicQuery
+
+    unittest.main()
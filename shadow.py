@@ -0,0 +1,488 @@
+#!/usr/bin/python
+'''
+Public-only views or shadow tables as query target.
+
+Instead of adding criterion to each statement, ShadowPublicQuery selects
+from relations holding public rows only: each table of filtered class is
+replaced with "public_<table>" aliased to original name, so that the rest of
+statement (columns, join conditions, correlation) stays intact:
+
+    SELECT "user".id, ... FROM public_user AS "user"
+
+The relations are either views (always consistent, but database still scans
+base table) or tables maintained by triggers, having size and indexes of
+public rows only. Rows of table belong to the top-most class mapped to it,
+subclass criteria of polymorphic classes are applied to rows of their types.
+Criteria of other audiences are not stored, queries narrowed with
+audience() filter base tables as combined.PublicQuery does.
+
+Usage:
+
+    python shadow.py ddl MODULE [--dialect sqlite] [--views]
+    python shadow.py sync MODULE URL
+    python shadow.py check MODULE URL
+
+MODULE is imported to map classes. Shadow tables created by ddl are filled
+by sync, check reports rows differing from publicity criteria (exit status 1
+when there are any), e.g. of stale views after criteria have changed.
+'''
+
+import argparse
+import numbers
+import sys
+import warnings
+from collections import OrderedDict
+from sqlalchemy import create_engine, and_, select, literal_column
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.orm import mapperlib
+from sqlalchemy.schema import MetaData, Table, Column, Index, CreateTable, \
+                              CreateIndex
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.util import _deep_deannotate
+from sqlalchemy.sql.expression import TableClause, Alias, ColumnClause, \
+                                      _Exists, _BindParamClause
+from publicity import entity_criterion, polymorphic_criterion, generation, \
+                      NOT_FILTERED
+from combined import PublicQuery, _outer_tables
+
+PREFIX = 'public_'
+
+
+def _row_mappers(mappers):
+    # Table -> the top-most mapper with it as local table, rows of table
+    # belong to its hierarchy
+    result = {}
+    for mapper in mappers:
+        table = mapper.local_table
+        if not isinstance(table, Table) or \
+                mapper.inherits is not None and \
+                mapper.inherits.local_table is table:
+            continue
+        result[table] = mapper
+    return result
+
+
+def row_criterion(mapper):
+    '''Returns criterion of public rows of local table of mapper (the
+    top-most one mapped to it) or NOT_FILTERED.'''
+    if mapper.polymorphic_on is not None:
+        crit = polymorphic_criterion(mapper)
+    else:
+        crit = entity_criterion(mapper)
+    table = mapper.local_table
+    if crit is NOT_FILTERED or _outer_tables(crit)<=set([table]):
+        return crit
+    # Criterion refers to tables of superclasses
+    if len(table.primary_key)!=1:
+        raise sa_exc.InvalidRequestError(
+                    'Shadow of %s with composite primary key' % table)
+    public_ids = select([mapper.primary_key[0]], crit,
+                        from_obj=[mapper.mapped_table])
+    return list(table.primary_key)[0].in_(public_ids.correlate(None))
+
+
+def public_tables(base):
+    '''Returns ordered dictionary mapping tables of classes from declarative
+    base to criteria of their public rows.'''
+    classes = sorted(base._decl_class_registry.values(),
+                     key=lambda cls: cls.__name__)
+    mappers = [cls.__mapper__ for cls in classes
+               if hasattr(cls, '__mapper__')]
+    result = OrderedDict()
+    for table, mapper in sorted(_row_mappers(mappers).items(),
+                                key=lambda item: item[0].name):
+        try:
+            crit = row_criterion(mapper)
+        except Exception as exc:
+            warnings.warn('Skipping %s with broken publicity criterion: %r'
+                          % (mapper.class_.__name__, exc))
+            continue
+        if crit is not NOT_FILTERED:
+            result[table] = crit
+    return result
+
+
+def shadow_table(table, prefix=PREFIX):
+    '''Returns table with the same columns for public rows of table, foreign
+    keys are indexed.'''
+    shadow = Table(prefix + table.name, MetaData(), schema=table.schema,
+                   *[Column(col.name, col.type, primary_key=col.primary_key)
+                     for col in table.columns])
+    for fk in sorted(table.foreign_keys, key=lambda fk: fk.parent.name):
+        if not fk.parent.primary_key:
+            Index('ix_%s_%s' % (shadow.name, fk.parent.name),
+                  shadow.c[fk.parent.name])
+    return shadow
+
+
+def _literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, numbers.Number):
+        return str(value)
+    if isinstance(value, (str, type(u''))):
+        return "'%s'" % value.replace("'", "''")
+    raise sa_exc.InvalidRequestError("Can't render %r in DDL" % (value,))
+
+
+def _literal_binds(clause):
+    # Views and triggers can't have parameters (e.g. polymorphic identities)
+    return visitors.replacement_traverse(
+                clause, {},
+                lambda elem: literal_column(_literal(elem.value), elem.type)
+                             if isinstance(elem, _BindParamClause) else None)
+
+
+def _pk(table):
+    if len(table.primary_key)!=1:
+        raise sa_exc.InvalidRequestError(
+                    'Shadow of %s with composite primary key' % table)
+    return list(table.primary_key)[0]
+
+
+def _copy_rows(table, shadow, crit, dialect, key=None):
+    # INSERT ... SELECT of public rows (with primary key key)
+    if key is not None:
+        crit = and_(_pk(table)==key, crit)
+    rows = select(list(table.columns), _literal_binds(crit))
+    return 'INSERT INTO %s (%s) %s' % (
+                dialect.identifier_preparer.format_table(shadow),
+                ', '.join(dialect.identifier_preparer.format_column(col)
+                          for col in shadow.columns),
+                unicode(rows.compile(dialect=dialect)))
+
+
+def _trigger_ddl(table, shadow, crit, dialect):
+    # SQLite triggers copying rows of table and of superclass tables
+    # referred to by criterion on each change
+    preparer = dialect.identifier_preparer
+    pk = _pk(table)
+    def delete(key):
+        return unicode(shadow.delete(shadow.c[pk.name]==key)
+                             .compile(dialect=dialect))
+    def trigger(name, event, source, body):
+        return 'CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW BEGIN %s; ' \
+               'END' % (preparer.quote(name, None), event,
+                        preparer.format_table(source), '; '.join(body))
+    def row(source, alias):
+        return literal_column('%s.%s' % (alias,
+                                         preparer.format_column(_pk(source))))
+    statements = []
+    sources = [table] + sorted(_criterion_sources(table, crit),
+                               key=lambda source: source.name)
+    for source in sources:
+        name = shadow.name if source is table \
+               else '%s_%s' % (shadow.name, source.name)
+        new, old = row(source, 'NEW'), row(source, 'OLD')
+        resync = [delete(new), _copy_rows(table, shadow, crit, dialect, new)]
+        statements.append(trigger(name + '_insert', 'INSERT', source,
+                                  resync))
+        statements.append(trigger(name + '_update', 'UPDATE', source,
+                                  [delete(old)] + resync))
+        if source is table:
+            body = [delete(old)]
+        else:
+            body = [delete(old),
+                    _copy_rows(table, shadow, crit, dialect, old)]
+        statements.append(trigger(name + '_delete', 'DELETE', source, body))
+    return statements
+
+
+def _criterion_sources(table, crit):
+    # Other tables referred to by criterion of table. Only tables of the same
+    # inheritance hierarchy are supported, since their rows share primary
+    # key values.
+    mapper = _row_mappers(mapperlib._mapper_registry)[table]
+    hierarchy = set(m.local_table for m in
+                    mapper.base_mapper.self_and_descendants)
+    sources = set(elem.table for elem in visitors.iterate(crit, {})
+                  if isinstance(elem, Column) and
+                     isinstance(elem.table, Table)) - set([table])
+    for source in sources:
+        if source not in hierarchy or len(source.primary_key)!=1:
+            raise sa_exc.InvalidRequestError(
+                        'Shadow table of %s depends on %s, use view' %
+                        (table.name, source.name))
+    return sources
+
+
+def shadow_ddl(base, dialect, views=False, prefix=PREFIX):
+    '''Returns list of statements creating views or shadow tables (with
+    triggers, SQLite only) for tables of base.'''
+    if not views and dialect.name!='sqlite':
+        raise sa_exc.InvalidRequestError('Shadow table triggers for %s'
+                                         % dialect.name)
+    preparer = dialect.identifier_preparer
+    statements = []
+    for table, crit in public_tables(base).items():
+        shadow = shadow_table(table, prefix)
+        if views:
+            rows = select(list(table.columns), _literal_binds(crit))
+            statements.append('CREATE VIEW %s AS %s' % (
+                                preparer.format_table(shadow),
+                                unicode(rows.compile(dialect=dialect))))
+            continue
+        statements.append(unicode(CreateTable(shadow).compile(
+                                                        dialect=dialect)))
+        for index in sorted(shadow.indexes, key=lambda index: index.name):
+            statements.append(unicode(CreateIndex(index).compile(
+                                                        dialect=dialect)))
+        statements.extend(_trigger_ddl(table, shadow, crit, dialect))
+    return statements
+
+
+def sync(conn, base, prefix=PREFIX):
+    '''Refills shadow tables of base from their tables.'''
+    for table, crit in public_tables(base).items():
+        shadow = shadow_table(table, prefix)
+        conn.execute(shadow.delete())
+        conn.execute(_copy_rows(table, shadow, crit, conn.dialect))
+
+
+def check(conn, base, prefix=PREFIX):
+    '''Returns list of human readable differences between views or shadow
+    tables and public rows of their tables.'''
+    problems = []
+    for table, crit in public_tables(base).items():
+        shadow = shadow_table(table, prefix)
+        pk = _pk(table)
+        expected = dict((row[pk.name], tuple(row)) for row in
+                        conn.execute(select(list(table.columns), crit)))
+        actual = dict((row[pk.name], tuple(row)) for row in
+                      conn.execute(select(list(shadow.columns))))
+        for title, keys in [
+                ('missing', set(expected)-set(actual)),
+                ('extra', set(actual)-set(expected)),
+                ('stale', [key for key in set(expected)&set(actual)
+                           if expected[key]!=actual[key]])]:
+            if keys:
+                problems.append('%s: %d %s rows, %s=%s' % (
+                            shadow.name, len(keys), title, pk.name,
+                            ', '.join(map(str, sorted(keys)))))
+    return problems
+
+
+# (registry generation, {table: None or exception raised building its
+# criterion})
+_shadowed = (None, {})
+
+def _shadowed_tables():
+    global _shadowed
+    if _shadowed[0]!=generation():
+        tables = {}
+        for table, mapper in _row_mappers(
+                                list(mapperlib._mapper_registry)).items():
+            try:
+                crit = row_criterion(mapper)
+            except Exception as exc:
+                tables[table] = exc
+                continue
+            if crit is not NOT_FILTERED:
+                tables[table] = None
+        _shadowed = generation(), tables
+    return _shadowed[1]
+
+
+# (table, alias name, prefix) -> alias of shadow
+_aliases = {}
+
+def shadow_statement(statement, prefix=PREFIX):
+    '''Returns statement selecting from shadows of filtered tables.'''
+    tables = _shadowed_tables()
+    elems = list(visitors.iterate(statement, {}))
+    def replace(elem):
+        if isinstance(elem, _Exists):
+            # Relationship comparators protect subquery from replacement
+            # with annotations
+            exists = elem._clone()
+            exists.element = visitors.replacement_traverse(
+                                _deep_deannotate(elem.element), opts,
+                                replace_subquery)
+            return exists
+        if isinstance(elem, Alias):
+            table, name = elem.element._deannotate(), elem.name
+        elif isinstance(elem, TableClause):
+            # ORM annotates tables in relationship criteria
+            table, name = elem._deannotate(), elem.name
+        else:
+            return None
+        if table not in tables:
+            return None
+        if tables[table] is not None:
+            raise tables[table]
+        key = table, name, prefix
+        if key not in _aliases:
+            _aliases[key] = shadow_table(table, prefix).alias(name)
+        return _aliases[key]
+    def replace_subquery(elem):
+        # FROM list of subquery is derived from columns, so columns of
+        # aliases (e.g. any() of aliased class) are replaced too
+        if isinstance(elem, ColumnClause) and isinstance(elem.table, Alias):
+            alias = replace(elem.table)
+            if alias is not None:
+                return alias.c[elem.key]
+        return replace(elem)
+    # Leave parameters as is, statement cache maps values to them
+    opts = {'stop_on': [elem for elem in elems
+                        if isinstance(elem, _BindParamClause)]}
+    return visitors.replacement_traverse(statement, opts, replace)
+
+
+class ShadowPublicQuery(PublicQuery):
+
+    '''
+    combined.PublicQuery selecting public rows from views or shadow tables
+    named with shadow_prefix.
+    '''
+
+    shadow_prefix = PREFIX
+    # Cleared for subquery of from_self(): it's shadowed with the outer
+    # statement, otherwise entities can't be adapted to its columns
+    _shadowed = True
+
+    def private(self):
+        if self._audience is not None:
+            return PublicQuery.private(self)
+        return self
+
+    def from_self(self, *ent):
+        query = self._clone()
+        query._shadowed = False
+        query = PublicQuery.from_self(query, *ent)
+        query._shadowed = True
+        return query
+
+    def _compile_context(self, labels=True):
+        context = PublicQuery._compile_context(self, labels)
+        if self._audience is None and self._shadowed:
+            context.statement = shadow_statement(context.statement,
+                                                 self.shadow_prefix)
+        return context
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    ddl_parser = commands.add_parser(
+                'ddl', help='print DDL of shadow tables or views')
+    ddl_parser.add_argument('module')
+    ddl_parser.add_argument('--dialect', default='sqlite')
+    ddl_parser.add_argument('--views', action='store_true')
+    for command, help in [('sync', 'refill shadow tables'),
+                          ('check', 'report inconsistent rows')]:
+        command_parser = commands.add_parser(command, help=help)
+        command_parser.add_argument('module')
+        command_parser.add_argument('url')
+    args = parser.parse_args(argv)
+    base = __import__(args.module).Base
+
+    if args.command=='ddl':
+        module = __import__('sqlalchemy.dialects.' + args.dialect,
+                            fromlist=['dialect'])
+        for ddl in shadow_ddl(base, module.dialect(), args.views):
+            sys.stdout.write(ddl + ';\n')
+        return 0
+
+    engine = create_engine(args.url)
+    try:
+        with engine.begin() as conn:
+            if args.command=='sync':
+                sync(conn, base)
+                return 0
+            problems = check(conn, base)
+    finally:
+        engine.dispose()
+    for problem in problems:
+        sys.stdout.write(problem + '\n')
+    return 1 if problems else 0
+
+
+if __name__=='__main__':
+    if len(sys.argv)>1:
+        sys.exit(main())
+
+    import unittest
+    from sqlalchemy import text
+    import base
+    from base import User, Doc, Event
+
+    class ShadowTablesTest(base.DataTestCase):
+
+        # Shadows are created after fixture, so that sync() fills them
+
+        QUERY_CLS = ShadowPublicQuery
+        VIEWS = False
+
+        def create_public_session(self, engine):
+            for ddl in shadow_ddl(base.Base, engine.dialect, self.VIEWS):
+                self.dba.execute(text(ddl))
+            if not self.VIEWS:
+                sync(self.dba.connection(), base.Base)
+            self.dba.commit()
+            return base.DataTestCase.create_public_session(self, engine)
+
+        def test_statement(self):
+            sql = str(self.dbp.query(User).join(User.addresses).statement)
+            self.assertIn('FROM public_user AS "user" JOIN public_address '
+                          'AS address', sql)
+            self.assertNotIn('WHERE', sql)
+
+        def test_polymorphic(self):
+            titles = sorted(doc.title for doc in self.dbp.query(Doc))
+            self.assertEqual(titles, ['a1', 'e1', 'n1'])
+            query = self.dbp.query(Doc).with_polymorphic('*')
+            self.assertEqual(sorted(doc.title for doc in query),
+                             ['a1', 'e1', 'n1'])
+            self.assertEqual([e.title for e in self.dbp.query(Event)],
+                             ['e1'])
+
+        def test_audience(self):
+            query = self.dbp.query(User).audience('staff')
+            self.assertEqual(query.count(), 6)
+            self.assertNotIn('public_', str(query.statement))
+
+        def test_changes(self):
+            self.dba.execute(text("UPDATE event SET approved=1 WHERE id="
+                                  "(SELECT id FROM doc WHERE title='e2')"))
+            self.dba.query(User).filter_by(name='u1').delete()
+            self.assertEqual(check(self.dba.connection(), base.Base), [])
+            self.dba.commit()
+            self.assertEqual(sorted(d.title for d in self.dbp.query(Doc)),
+                             ['a1', 'e1', 'e2', 'n1'])
+            self.assertEqual(self.dbp.query(User).count(), 3)
+
+        def test_check(self):
+            conn = self.dba.connection()
+            conn.execute(text("DELETE FROM public_address "
+                              "WHERE email='u1a1'"))
+            conn.execute(text("UPDATE public_user SET name='x' "
+                              "WHERE name='u2'"))
+            self.assertEqual(
+                [problem.split(',')[0] for problem in check(conn, base.Base)],
+                ['public_address: 1 missing rows',
+                 'public_user: 1 stale rows'])
+            sync(conn, base.Base)
+            self.assertEqual(check(conn, base.Base), [])
+
+    class ShadowViewsTest(ShadowTablesTest):
+
+        VIEWS = True
+
+        def test_check(self):
+            # View created with criterion changed since
+            conn = self.dba.connection()
+            conn.execute(text('DROP VIEW public_user'))
+            conn.execute(text('CREATE VIEW public_user AS '
+                              'SELECT * FROM "user"'))
+            self.assertEqual(
+                [problem.split(',')[0] for problem in check(conn, base.Base)],
+                ['public_user: 2 extra rows'])
+
+    # Imported test cases would be run by unittest.main() too
+    for name in unittest.TestLoader().getTestCaseNames(base.UserAddressesTest):
+        setattr(ShadowTablesTest, name,
+                base.UserAddressesTest.__dict__[name])
+
+    unittest.main()
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+'''
+Publicity filtering for horizontally sharded databases.
+
+ShardedPublicQuery is combined.PublicQuery for ShardedSession (from
+sqlalchemy.ext.horizontal_shard). Filtered statement is built once and
+executed on all shards returned by query_chooser concurrently in a thread
+pool, then rows are merged in the main thread:
+
+  * results are ordered by ORDER BY of the query, its expressions are
+    added to selected columns for this;
+  * LIMIT and OFFSET are applied to merged results, each shard is asked for
+    offset+limit rows;
+  * count() adds numbers of rows of shards.
+
+Rows of distinct() and group_by() queries are not merged across shards, so
+they are correct only when each group lives in a single shard. Primary keys
+must be unique across shards, since identity map doesn't distinguish them.
+Connections are used from worker threads, so SQLite databases must be
+opened with check_same_thread=False.
+'''
+
+import threading
+from functools import cmp_to_key
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import func, literal_column, exc as sa_exc, util
+from sqlalchemy.ext.horizontal_shard import ShardedQuery
+from sqlalchemy.orm.query import Query
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import ColumnElement, _UnaryExpression
+from combined import PublicQuery
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(size):
+    with _pools_lock:
+        if size not in _pools:
+            _pools[size] = ThreadPool(size)
+        return _pools[size]
+
+
+class _Rows(object):
+    # Result for Query.instances() made of rows fetched already
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+def _sortable(statement):
+    # Adds ORDER BY expressions as labeled columns to statement, so that
+    # merged rows can be ordered by them. Returns new statement and
+    # [(label name, descending)].
+    spec = []
+    for clause in statement._order_by_clause.clauses:
+        descending = False
+        if isinstance(clause, _UnaryExpression) and \
+                clause.modifier in (operators.asc_op, operators.desc_op):
+            descending = clause.modifier is operators.desc_op
+            clause = clause.element
+        if not isinstance(clause, ColumnElement):
+            raise sa_exc.InvalidRequestError(
+                        "Can't merge results of shards ordered by %r" %
+                        clause)
+        name = '_sort_%d' % len(spec)
+        statement = statement.column(clause.label(name))
+        spec.append((name, descending))
+    return statement, spec
+
+
+def _cmp(a, b):
+    return (a>b) - (a<b)
+
+
+def _merge(results, spec):
+    rows = [row for shard_rows in results for row in shard_rows]
+    if not spec or len(results)<2:
+        return rows
+    def compare(a, b):
+        for name, descending in spec:
+            result = _cmp(a[name], b[name])
+            if result:
+                return -result if descending else result
+        return 0
+    # Stable, so rows of each shard keep their order
+    return sorted(rows, key=cmp_to_key(compare))
+
+
+class ShardedPublicQuery(PublicQuery, ShardedQuery):
+
+    # Number of threads executing statement on shards
+    pool_size = 8
+
+    def __init__(self, entities, session=None):
+        # PublicQuery doesn't call __init__() of ShardedQuery
+        PublicQuery.__init__(self, entities, session)
+        self.id_chooser = session.id_chooser
+        self.query_chooser = session.query_chooser
+        self._shard_id = None
+
+    def _fan_out(self, statement):
+        # Connections are obtained from session in this thread, since
+        # session is not thread-safe.
+        conns = [self._connection_from_session(
+                                mapper=self._mapper_zero_or_none(),
+                                shard_id=shard_id, close_with_result=True)
+                 for shard_id in self.query_chooser(self)]
+        params = self._params
+        def fetch(conn):
+            return conn.execute(statement, params).fetchall()
+        return _pool(self.pool_size).map(fetch, conns)
+
+    def _shard_query(self):
+        # The same query asking each shard for all rows the merged result
+        # might need
+        query = self
+        if self._limit is not None or self._offset is not None:
+            query = self._clone()
+            if self._limit is not None:
+                query._limit = self._limit + (self._offset or 0)
+            query._offset = None
+        return query
+
+    def _execute_and_instances(self, context):
+        if self._shard_id is not None:
+            return ShardedQuery._execute_and_instances(self, context)
+        query = self._shard_query()
+        if query is not self:
+            context = query._compile_context()
+            context.statement.use_labels = True
+        statement, spec = _sortable(context.statement)
+        rows = _merge(self._fan_out(statement), spec)
+        instances = query.instances(_Rows(rows), context)
+        if query is self:
+            return instances
+        start = self._offset or 0
+        stop = None if self._limit is None else start + self._limit
+        return iter(list(instances)[start:stop])
+
+    def get(self, ident):
+        if self._shard_id is not None:
+            return PublicQuery.get(self, ident)
+        for shard_id in self.id_chooser(self, util.to_list(ident)):
+            obj = self.set_shard(shard_id).get(ident)
+            if obj is not None:
+                return obj
+        return None
+
+    def count(self):
+        if self._shard_id is not None:
+            return PublicQuery.count(self)
+        query = self.private()
+        if query._autoflush:
+            query.session._autoflush()
+        shard_query = query._shard_query()
+        if shard_query._count_wrapped():
+            # Criterion is already applied, don't call our from_self()
+            col = func.count(literal_column('*'))
+            statement = Query.from_self(shard_query, col).statement
+        else:
+            statement = shard_query._flat_count_statement()
+        total = sum(rows[0][0] for rows in query._fan_out(statement))
+        if query._offset:
+            total = max(total-query._offset, 0)
+        if query._limit is not None:
+            total = min(total, query._limit)
+        return total
+
+
+if __name__=='__main__':
+    import os
+    import shutil
+    import tempfile
+    import unittest
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.ext.horizontal_shard import ShardedSession
+    from sqlalchemy.orm import sessionmaker, joinedload
+    from base import Base, User, Address
+
+    class ShardTest(unittest.TestCase):
+
+        # Users with odd and even ids live in different databases together
+        # with their addresses.
+
+        def shard_chooser(self, mapper, instance, clause=None):
+            if isinstance(instance, User):
+                return 'shard%d' % (instance.id%2)
+            if isinstance(instance, Address):
+                return 'shard%d' % (instance.user_id%2)
+            return 'shard0'
+
+        def id_chooser(self, query, ident):
+            if query._mapper_zero().class_ is User:
+                return ['shard%d' % (ident[0]%2)]
+            return self.shards.keys()
+
+        def query_chooser(self, query):
+            return sorted(self.shards)
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.shards = {}
+            self.threads = []
+            for i in range(2):
+                engine = create_engine(
+                            'sqlite:///' + os.path.join(self.dir, '%d.db' % i),
+                            connect_args={'check_same_thread': False})
+                Base.metadata.create_all(engine)
+                @event.listens_for(engine, 'before_cursor_execute')
+                def record(*args):
+                    self.threads.append(threading.current_thread())
+                self.shards['shard%d' % i] = engine
+            Session = sessionmaker(class_=ShardedSession,
+                                   shard_chooser=self.shard_chooser,
+                                   id_chooser=self.id_chooser,
+                                   query_chooser=self.query_chooser,
+                                   shards=self.shards)
+            dba = Session()
+            for i, public in enumerate([True, True, False, True, False,
+                                        True, True], 1):
+                dba.add(User(id=i, name='u%d' % i, public=public))
+                for j, addr_public in enumerate([True, False], 1):
+                    dba.add(Address(id=i*10+j, user_id=i,
+                                    email='u%da%d' % (i, j),
+                                    public=addr_public))
+            dba.commit()
+            dba.close()
+            self.dbp = Session(query_cls=ShardedPublicQuery)
+            del self.threads[:]
+
+        def tearDown(self):
+            self.dbp.close()
+            for engine in self.shards.values():
+                engine.dispose()
+            shutil.rmtree(self.dir)
+
+        def test_iter(self):
+            names = set(u.name for u in self.dbp.query(User))
+            self.assertEqual(names, set(['u1', 'u2', 'u4', 'u6', 'u7']))
+            self.assertEqual(len(self.threads), 2)
+            self.assertNotIn(threading.current_thread(), self.threads)
+
+        def test_order_by(self):
+            query = self.dbp.query(User).order_by(User.name.desc())
+            self.assertEqual([u.name for u in query],
+                             ['u7', 'u6', 'u4', 'u2', 'u1'])
+            query = self.dbp.query(Address.email, User.name)\
+                            .join(Address.user).order_by(Address.id)
+            self.assertEqual([email for email, name in query],
+                             ['u1a1', 'u2a1', 'u4a1', 'u6a1', 'u7a1'])
+
+        def test_order_by_expression(self):
+            query = self.dbp.query(User.name).order_by(User.id*-1)
+            self.assertEqual([name for (name,) in query],
+                             ['u7', 'u6', 'u4', 'u2', 'u1'])
+            query = self.dbp.query(User).order_by('user.name')
+            self.assertRaises(sa_exc.InvalidRequestError, query.all)
+
+        def test_limit_offset(self):
+            query = self.dbp.query(User).order_by(User.id)
+            self.assertEqual([u.name for u in query.limit(3)],
+                             ['u1', 'u2', 'u4'])
+            self.assertEqual([u.name for u in query.offset(2)],
+                             ['u4', 'u6', 'u7'])
+            self.assertEqual([u.name for u in query[1:4]],
+                             ['u2', 'u4', 'u6'])
+            self.assertEqual(query[3].name, 'u6')
+
+        def test_limit_joinedload(self):
+            query = self.dbp.query(User).options(joinedload(User.addresses))\
+                            .order_by(User.id.desc())
+            users = query.limit(2).all()
+            self.assertEqual([u.name for u in users], ['u7', 'u6'])
+            self.assertIn('addresses', users[0].__dict__)
+
+        def test_count(self):
+            self.assertEqual(self.dbp.query(User).count(), 5)
+            self.assertEqual(self.dbp.query(Address).count(), 7)
+            query = self.dbp.query(User).order_by(User.id)
+            self.assertEqual(query.limit(3).count(), 3)
+            self.assertEqual(query.offset(3).count(), 2)
+            self.assertEqual(query.offset(4).limit(3).count(), 1)
+            self.assertEqual(query.offset(9).count(), 0)
+            query = self.dbp.query(Address.user_id).distinct()
+            self.assertEqual(query.count(), 7)
+
+        def test_get(self):
+            self.assertEqual(self.dbp.query(User).get(4).name, 'u4')
+            self.assertIsNone(self.dbp.query(User).get(5))
+            self.assertEqual(self.dbp.query(Address).get(11).email, 'u1a1')
+            self.assertIsNone(self.dbp.query(Address).get(12))
+
+        def test_lazy_load(self):
+            user = self.dbp.query(User).get(6)
+            self.assertEqual([a.email for a in user.addresses], ['u6a1'])
+
+    unittest.main()
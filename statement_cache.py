@@ -0,0 +1,281 @@
+'''
+Cache of compiled publicity-filtered statements.
+
+Queries of the same shape (same entities, joins, criterion structure, options
+etc., but possibly different values of bound parameters) share compiled
+statement with publicity criterion already injected, so repeated execution
+skips both private() and SQL compilation. Values of bound parameters are
+extracted from the query being executed and passed to the cached statement.
+
+Query shapes that can't be reliably fingerprinted (aliased entities, unknown
+clause constructs etc.) are executed without cache.
+'''
+
+import copy
+import threading
+import types
+from collections import OrderedDict
+from timeit import default_timer as time
+from sqlalchemy.orm.query import Query
+from sqlalchemy.orm.interfaces import MapperProperty, MapperOption
+from sqlalchemy.orm.mapper import Mapper
+from sqlalchemy.orm.attributes import QueryableAttribute
+from sqlalchemy.sql import ClauseElement, visitors
+from sqlalchemy.sql.expression import TableClause, _anonymous_label
+from sqlalchemy.types import TypeEngine
+import publicity
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+# Marks shape which has been tried and found uncacheable
+_UNCACHEABLE = object()
+
+# Attributes of clause elements (by visit name) affecting SQL besides their
+# children. Elements not listed here make query uncacheable.
+_CLAUSE_ATTRS = {
+    'binary': ('operator', 'negate', 'modifiers', 'type'),
+    'unary': ('operator', 'modifier', 'negate', 'type'),
+    'clauselist': ('operator', 'group', 'group_contents'),
+    'grouping': (),
+    'cast': ('type',),
+    'typeclause': ('type',),
+    'function': ('name', 'packagenames', 'type'),
+    'textclause': ('text', 'typemap'),
+    'null': (),
+    'true': (),
+    'false': (),
+    'case': ('type',),
+    'extract': ('field',),
+    'over': (),
+    'join': ('isouter',),
+    'select': ('_should_correlate', '_distinct', '_correlate', 'use_labels',
+               'for_update', '_limit', '_offset', '_hints'),
+}
+
+_PLAIN_TYPES = (type(None), bool, int, long, float, basestring)
+_SAFE_OBJECTS = (type, types.FunctionType, types.BuiltinFunctionType,
+                 Mapper, MapperProperty)
+
+# Query attributes derived from others or not affecting statement
+_IGNORED_ATTRS = frozenset([
+    'session', '_mapper_adapter_map', '_polymorphic_adapters', '_joinpath',
+    '_joinpoint', '_autoflush', '_enable_assertions', '_params',
+])
+# Query attributes we don't know how to fingerprint
+_UNCACHEABLE_ATTRS = frozenset([
+    '_statement', '_refresh_state', '_from_obj_alias', '_filter_aliases',
+])
+
+
+class _KeyBuilder(object):
+
+    def __init__(self):
+        self.binds = []
+
+    def value(self, value):
+        if isinstance(value, _PLAIN_TYPES):
+            return (type(value), value)
+        if isinstance(value, ClauseElement):
+            return self.clause(value)
+        if isinstance(value, (tuple, list)):
+            return tuple(self.value(item) for item in value)
+        if isinstance(value, (set, frozenset)):
+            return frozenset(self.value(item) for item in value)
+        if isinstance(value, dict):
+            return frozenset((self.value(k), self.value(v))
+                             for k, v in value.items())
+        if isinstance(value, TypeEngine):
+            return (type(value), repr(value))
+        if isinstance(value, QueryableAttribute):
+            if not isinstance(value.parententity, Mapper):
+                raise _Uncacheable(value)
+            return ('attr', value.parententity, value.key)
+        if isinstance(value, _SAFE_OBJECTS):
+            return value
+        raise _Uncacheable(value)
+
+    def clause(self, clause):
+        key = []
+        for elem in visitors.iterate(clause, {}):
+            name = elem.__visit_name__
+            if name=='bindparam':
+                self.binds.append(elem)
+                key.append((name, elem._orig_key, elem.unique,
+                            self.value(elem.type)))
+            elif name=='column':
+                table = elem.table
+                if table is not None and \
+                        not isinstance(table, TableClause):
+                    raise _Uncacheable(elem)
+                # Hash of annotated element is the one of original, so
+                # columns are identified the same way each time.
+                key.append((name, hash(elem), elem.name, elem.is_literal,
+                            table is not None and hash(table)))
+            elif name=='label':
+                # Anonymous names are unique for each label object, but
+                # rendered the same way.
+                label = elem.name
+                if isinstance(label, _anonymous_label):
+                    label = None
+                key.append((name, label, self.value(elem.type)))
+            elif name=='table':
+                key.append((name, hash(elem)))
+            elif name in _CLAUSE_ATTRS:
+                key.append((name,) + tuple(
+                            self.value(getattr(elem, attr, None))
+                            for attr in _CLAUSE_ATTRS[name]))
+            else:
+                raise _Uncacheable(elem)
+        return tuple(key)
+
+    def entity(self, query_entity):
+        if hasattr(query_entity, 'column'):
+            return ('column', query_entity._label_name,
+                    self.clause(query_entity.column))
+        mapper = getattr(query_entity, 'mapper', None)
+        if mapper is None or query_entity.is_aliased_class or \
+                query_entity.adapter is not None:
+            raise _Uncacheable(query_entity)
+        return ('mapper', mapper,
+                self.value(query_entity._with_polymorphic),
+                self.value(query_entity._polymorphic_discriminator))
+
+    def option(self, option):
+        if not isinstance(option, MapperOption):
+            raise _Uncacheable(option)
+        return (type(option), self.value(vars(option)))
+
+    def query(self, query):
+        key = []
+        for name, value in sorted(query.__dict__.items()):
+            if name in _IGNORED_ATTRS:
+                continue
+            if name in _UNCACHEABLE_ATTRS:
+                if value is None:
+                    continue
+                raise _Uncacheable(name)
+            if name=='_entities':
+                value = tuple(self.entity(ent) for ent in value)
+            elif name=='_with_options':
+                value = tuple(self.option(opt) for opt in value)
+            else:
+                value = self.value(value)
+            key.append((name, value))
+        key.append(('_params', tuple(sorted(query._params))))
+        return (type(query),) + tuple(key)
+
+
+class _Entry(object):
+
+    def __init__(self, query, context, compiled, bind_names):
+        self.query = query
+        self.context = context
+        self.compiled = compiled
+        self.bind_names = bind_names
+
+
+class StatementCache(object):
+
+    '''
+    Bounded LRU cache of compiled publicity-filtered statements. Set it as
+    statement_cache attribute of combined.PublicQuery (or its subclass) to
+    enable. Cache is cleared automatically when publicity criteria registry
+    changes.
+    '''
+
+    def __init__(self, size=500):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = publicity.generation()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation = publicity.generation()
+
+    def _get(self, key):
+        with self._lock:
+            if self._generation!=publicity.generation():
+                self._entries.clear()
+                self._generation = publicity.generation()
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[key] = entry
+            return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries)>self.size:
+                self._entries.popitem(last=False)
+
+    def _compile(self, query, dialect, binds):
+        private = query.private()
+        context = private._compile_context()
+        context.statement.use_labels = True
+        started = time()
+        compiled = context.statement.compile(dialect=dialect)
+        if query.metrics_sink is not None:
+            query.metrics_sink('compile_time', time()-started,
+                               query._mapped_classes())
+        bind_names = [compiled.bind_names.get(bindparam)
+                      for bindparam in binds]
+        if None in bind_names:
+            # Some parameters were adapted during statement construction, we
+            # can't map values to them.
+            return _UNCACHEABLE
+        # Don't hold session of the query the entry is built from
+        private = private.with_session(None)
+        context.query = private
+        context.session = None
+        return _Entry(private, context, compiled, bind_names)
+
+    def execute(self, query):
+        '''Returns iterator over results of query like Query.__iter__()
+        does.'''
+        builder = _KeyBuilder()
+        try:
+            key = builder.query(query)
+        except _Uncacheable:
+            return Query.__iter__(query.private())
+        session = query.session
+        dialect = session.get_bind(query._mapper_zero_or_none()).dialect
+        key = (dialect, key)
+        entry = self._get(key)
+        if entry is None:
+            entry = self._compile(query, dialect, builder.binds)
+            self._put(key, entry)
+        if entry is _UNCACHEABLE:
+            return Query.__iter__(query.private())
+
+        cached = entry.query.with_session(session)
+        cached._params = query._params
+        context = copy.copy(entry.context)
+        context.query = cached
+        context.session = session
+        context.attributes = entry.context.attributes.copy()
+        params = dict(query._params)
+        for name, bindparam in zip(entry.bind_names, builder.binds):
+            # Values given with Query.params() override placeholders
+            if name not in query._params:
+                params[name] = bindparam.effective_value
+        if cached._autoflush and not cached._populate_existing:
+            session._autoflush()
+        conn = cached._connection_from_session(
+                        mapper=cached._mapper_zero_or_none(),
+                        clause=context.statement,
+                        close_with_result=True)
+        result = conn.execute(entry.compiled, params)
+        return cached.instances(result, context)
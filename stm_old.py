@@ -22,6 +22,9 @@ class PublicQuery(Query):
     patched version of SQLAlchemy.
     '''
 
+    # See combined.PublicQuery.reads_public
+    reads_public = True
+
     def __init__(self, entities, *args, **kwargs):
         Query.__init__(self, entities, *args, **kwargs)
         for entity in entities:
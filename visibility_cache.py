@@ -0,0 +1,224 @@
+'''
+Second-level cache of object visibility: (mapped class, primary key) ->
+whether the object is public.
+
+Set VisibilityCache instance as visibility_cache attribute of
+combined.PublicQuery (or its subclass). Then get() and many-to-one lazy loads
+of objects known to be private return None without querying, and get() of
+expired instance known to be public returns it without checking in database.
+
+Cached values are dropped for objects inserted, deleted or having "public"
+changed in sessions the cache is installed to (see VisibilityCache.install()),
+after flush, commit and rollback, so that other processes sharing backend
+don't pick up stale value in between. Values read by session with flushed
+changes of the same class are not stored. For classes with publicity
+provided by @hybrid_property any change of object drops its value. Changes made bypassing
+installed sessions are seen after TTL expires. Bulk updates (Query.update(),
+PublicQuery.set_public()) clear whole cache.
+
+Values are cached per audience (see publicity.register_audience()), changes
+drop values of all audiences.
+
+Backend stores string keys with boolean values. MemoryBackend is per
+process, SQLiteBackend uses a file shared by processes on the same host.
+Anything with get(), set(), delete_many() and clear() methods of the same
+semantics can be used, e.g. a wrapper around memcached.
+'''
+
+import os
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from timeit import default_timer
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+import publicity
+
+
+def cache_key(identity_key, audience=None):
+    '''Returns backend key for identity key of mapped object.'''
+    class_, ident = identity_key[:2]
+    key = '%s:%s' % (class_.__name__, ':'.join(map(unicode, ident)))
+    if audience is not None:
+        key = '%s/%s' % (audience, key)
+    return key
+
+
+class MemoryBackend(object):
+
+    '''
+    In-process LRU of at most size items, each expiring ttl seconds after it
+    was set. Default clock is not wall time, so it can't be shared by
+    processes.
+    '''
+
+    def __init__(self, size=10000, ttl=60, clock=default_timer):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires<=self.clock():
+                return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, self.clock()+self.ttl)
+            while len(self._items)>self.size:
+                self._items.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class SQLiteBackend(object):
+
+    '''
+    LRU with TTL stored in SQLite file, so it's shared by processes (and
+    survives restarts). Uses wall time clock.
+    '''
+
+    def __init__(self, path, size=100000, ttl=60, clock=None):
+        import time
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock or time.time
+        # Connections can't be shared by threads
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS visibility ('
+                         'key TEXT PRIMARY KEY, visible INTEGER NOT NULL, '
+                         'expires REAL NOT NULL, used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_visibility_used '
+                         'ON visibility (used)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid!=os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=10)
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        now = self.clock()
+        with self._connect() as conn:
+            row = conn.execute('SELECT visible FROM visibility '
+                               'WHERE key=? AND expires>?',
+                               (key, now)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE visibility SET used=? WHERE key=?',
+                         (now, key))
+            return bool(row[0])
+
+    def set(self, key, value):
+        now = self.clock()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO visibility '
+                         'VALUES (?, ?, ?, ?)',
+                         (key, int(value), now+self.ttl, now))
+            conn.execute('DELETE FROM visibility WHERE expires<=?', (now,))
+            conn.execute('DELETE FROM visibility WHERE key IN ('
+                         'SELECT key FROM visibility ORDER BY used DESC '
+                         'LIMIT -1 OFFSET ?)', (self.size,))
+
+    def delete_many(self, keys):
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM visibility WHERE key=?',
+                             [(key,) for key in keys])
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM visibility')
+
+
+class VisibilityCache(object):
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        # session -> keys of objects changed in current transaction
+        self._changed = weakref.WeakKeyDictionary()
+
+    def get(self, identity_key, audience=None):
+        '''Returns True or False for cached objects, None otherwise.'''
+        return self.backend.get(cache_key(identity_key, audience))
+
+    def set(self, identity_key, visible, audience=None, session=None):
+        '''Stores visibility read by session. It's not stored when session
+        has uncommitted changes of objects of the same class, since other
+        transactions don't see them.'''
+        changed = self._changed.get(session) if session is not None else None
+        if changed and any(key[0] is identity_key[0] for key in changed):
+            return
+        self.backend.set(cache_key(identity_key, audience), bool(visible))
+
+    def invalidate(self, identity_keys):
+        self.backend.delete_many([cache_key(key, audience)
+                                  for key in identity_keys
+                                  for audience in publicity.audiences()])
+
+    def clear(self):
+        self.backend.clear()
+
+    def install(self, target):
+        '''Listen to flushes and commits of target: Session class,
+        sessionmaker or session.'''
+        event.listen(target, 'after_flush', self._after_flush)
+        event.listen(target, 'after_commit', self._after_commit)
+        event.listen(target, 'after_rollback', self._after_rollback)
+        event.listen(target, 'after_bulk_update', self._after_bulk_change)
+        event.listen(target, 'after_bulk_delete', self._after_bulk_change)
+
+    def _after_flush(self, session, flush_context):
+        changed = list(session.new) + list(session.deleted)
+        for obj in session.dirty:
+            mapper = attributes.instance_state(obj).manager.mapper
+            names = publicity.policy_attributes(mapper)
+            if not all(mapper.has_property(name) for name in names):
+                # Criterion provided by @hybrid_property might depend on any
+                # attribute
+                if session.is_modified(obj):
+                    changed.append(obj)
+            elif any(attributes.get_history(obj, name).has_changes()
+                     for name in names):
+                changed.append(obj)
+        if changed:
+            # Keys of new objects are not set in their states yet
+            keys = set(attributes.instance_state(obj).manager.mapper
+                                    .identity_key_from_instance(obj)
+                       for obj in changed)
+            self.invalidate(keys)
+            self._changed.setdefault(session, set()).update(keys)
+
+    def _after_bulk_change(self, session, query, query_context, result):
+        # Changed rows are unknown
+        self.clear()
+
+    def _after_commit(self, session):
+        keys = self._changed.pop(session, None)
+        if keys:
+            self.invalidate(keys)
+
+    def _after_rollback(self, session):
+        # Values of flushed changes might be cached in between
+        keys = self._changed.pop(session, None)
+        if keys:
+            self.invalidate(keys)